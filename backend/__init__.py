@@ -35,7 +35,9 @@ def create_app(test_config=None):
         r"/stock/*": {
             "origins": ["http://localhost:5173"],
             "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-            "allow_headers": ["Content-Type", "Authorization"]
+            "allow_headers": ["Content-Type", "Authorization"],
+            "expose_headers": ["RateLimit-Limit", "RateLimit-Remaining", "RateLimit-Reset",
+                               "RateLimit-Policy", "Retry-After", "Warning"]
         }
     })
 
@@ -56,6 +58,14 @@ def create_app(test_config=None):
     from . import stock
     app.register_blueprint(stock.stock_bp)
 
+    # 创建限流后端（配置错误时启动失败，而不是每个请求都放行）
+    from .ratelimit import limiter
+    limiter.init_app(app)
+
+    # 启动耗时基准命令
+    from . import startup
+    app.cli.add_command(startup.startup_benchmark_command)
+
     # 错误处理
     @app.errorhandler(404)
     def not_found(error):
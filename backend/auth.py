@@ -1,61 +1,156 @@
 import os
 import jwt
+import time
+import uuid
 import datetime
 from functools import wraps
 from flask import (
     Blueprint, flash, g, redirect, render_template, request,
     session, url_for, jsonify, current_app
 )
-from werkzeug.security import check_password_hash, generate_password_hash
 from . import db
+from .cache import LRUCache
+from .passwords import hasher, HasherBusyError
+from .revocation import revocation_store, RevocationUnavailableError
 
 bp = Blueprint('auth', __name__, url_prefix='/api/auth')
 
+# 已验证token的缓存条数；每个token缓存到它的过期时间为止
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 4096))
+# 用户信息缓存的条数与有效期（秒）
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 4096))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 60))
+
+# token字符串 -> 解码后的payload，命中时跳过签名验证
+token_cache = LRUCache(maxsize=TOKEN_CACHE_SIZE)
+# 用户ID -> user表中的记录，命中时跳过数据库查询
+user_cache = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
 
 def hash_password(password):
-    return generate_password_hash(password)
+    return hasher.hash(password)
 
 
 def check_password(hash, password):
-    return check_password_hash(hash, password)
+    return hasher.verify(hash, password)
+
+
+def upgrade_password_hash(user, password):
+    """登录成功后，哈希参数与当前配置不同的旧哈希用新参数重新计算并保存"""
+    try:
+        # needs_rehash 首次调用时要在进程池中计算一次哈希，可能因繁忙或超时失败
+        if not hasher.needs_rehash(user['password']):
+            return
+        db.query_db(
+            'UPDATE user SET password = %s WHERE id = %s',
+            (hash_password(password), user['id'])
+        )
+        invalidate_user(user['id'])
+    except Exception as e:
+        # 升级失败不影响本次登录，下次登录时再试
+        print(f"升级用户 {user['id']} 的密码哈希失败: {e}")
+
+
+def busy_response():
+    response = jsonify({'error': 'Server is busy, please try again later.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
 
 
 def generate_token(user_id):
     payload = {
         'user_id': user_id,
+        'jti': uuid.uuid4().hex,  # token的唯一ID，用于吊销
         'exp': datetime.datetime.utcnow() + datetime.timedelta(days=1)
     }
     return jwt.encode(payload, current_app.config['SECRET_KEY'], algorithm='HS256')
 
 
+def decode_token(token):
+    """
+    验证并解码token，验证过的token缓存到过期时间为止
+    缓存键是完整的token字符串（含签名），伪造或篡改的token不会命中缓存
+    验证失败时抛出 jwt.InvalidTokenError（过期为其子类 jwt.ExpiredSignatureError）
+    """
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
+    payload = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+    exp = payload.get('exp')
+    if exp is not None:
+        ttl = exp - time.time()
+        if ttl > 0:
+            token_cache.set(token, payload, ttl=ttl)
+    return payload
+
+
+def load_user(user_id):
+    """按ID获取用户，短时间缓存；用户不存在时返回None（不缓存）"""
+    user = user_cache.get(user_id)
+    if user is None:
+        user = db.query_db(
+            'SELECT * FROM user WHERE id = %s',
+            (user_id,),
+            one=True
+        )
+        if user is None:
+            return None
+        user_cache.set(user_id, user)
+    # 返回副本，避免请求中修改 g.user 影响缓存
+    return dict(user)
+
+
+def invalidate_user(user_id):
+    """用户信息变化（修改、删除）后调用，使缓存失效"""
+    user_cache.delete(user_id)
+
+
+def auth_error(message):
+    # 同时提供 error 和 message，兼容两种错误格式的前端代码
+    return jsonify({'error': message, 'message': message}), 401
+
+
+def token_from_header(auth_header):
+    """
+    从 Authorization 头中取出token，支持 'Bearer <token>' 和直接传token两种写法
+    （股票接口原来的验证方式接受后者）；其他认证方式或格式不对时返回None
+    """
+    scheme, _, credentials = (auth_header or '').strip().partition(' ')
+    if not credentials:
+        return None if scheme.lower() == 'bearer' else scheme or None
+    if scheme.lower() == 'bearer':
+        return credentials.strip() or None
+    return None
+
+
 def token_required(f):
+    """JWT token验证装饰器，所有蓝图共用；验证通过后当前用户保存在 g.user"""
+
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        if 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
-            try:
-                token = auth_header.split(" ")[1]
-            except IndexError:
-                return jsonify({'message': 'Token is missing'}), 401
-
+        token = token_from_header(request.headers.get('Authorization'))
         if not token:
-            return jsonify({'message': 'Token is missing'}), 401
+            return auth_error('Token is missing')
 
         try:
-            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
-            current_user = db.query_db(
-                'SELECT * FROM user WHERE id = %s',
-                (data['user_id'],),
-                one=True
-            )
+            data = decode_token(token)
+            # 吊销检查只访问内存（布隆过滤器 + 精确集合）
+            revocation_store.start(current_app._get_current_object())
+            if revocation_store.is_revoked(data.get('jti')):
+                return auth_error('Token has been revoked')
+            current_user = load_user(data['user_id'])
             if not current_user:
-                return jsonify({'message': 'Invalid token'}), 401
+                return auth_error('Invalid token')
             g.user = current_user
+            g.token_payload = data
         except jwt.ExpiredSignatureError:
-            return jsonify({'message': 'Token has expired'}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({'message': 'Invalid token'}), 401
+            return auth_error('Token has expired')
+        except (jwt.InvalidTokenError, KeyError):
+            return auth_error('Invalid token')
+        except RevocationUnavailableError:
+            return busy_response()
 
         return f(*args, **kwargs)
 
@@ -75,10 +170,15 @@ def register():
         error = 'Password is required.'
 
     if error is None:
+        try:
+            password_hash = hash_password(password)
+        except HasherBusyError:
+            return busy_response()
+
         try:
             db.query_db(
                 'INSERT INTO user (username, password) VALUES (%s, %s)',
-                (username, hash_password(password))
+                (username, password_hash)
             )
         except Exception as e:
             error = f"User {username} is already registered."
@@ -107,12 +207,16 @@ def login():
             one=True
         )
 
-        if user is None:
-            error = 'Incorrect username.'
-        elif not check_password(user['password'], password):
-            error = 'Incorrect password.'
+        try:
+            if user is None:
+                error = 'Incorrect username.'
+            elif not check_password(user['password'], password):
+                error = 'Incorrect password.'
+        except HasherBusyError:
+            return busy_response()
 
         if error is None:
+            upgrade_password_hash(user, password)
             token = generate_token(user['id'])
             return jsonify({
                 'token': token,
@@ -126,6 +230,13 @@ def login():
 @bp.route('/logout', methods=['POST'])
 @token_required
 def logout():
+    """注销：吊销当前token，之后使用该token的请求都会被拒绝"""
+    payload = g.token_payload
+    if payload.get('jti') and payload.get('exp'):
+        try:
+            revocation_store.revoke(payload['jti'], payload['exp'], g.user['id'])
+        except Exception as e:
+            return jsonify({'error': f'Logout failed: {e}'}), 500
     return jsonify({'message': 'Successfully logged out'})
 
 
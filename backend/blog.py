@@ -1,36 +1,220 @@
+import os
+import base64
+import datetime
+import hashlib
+import json
+import threading
 from flask import (
     Blueprint, flash, g, redirect, render_template, request,
-    url_for, jsonify
+    url_for, jsonify, current_app
 )
-from . import db
+from . import db, search
 from .auth import token_required
+from .cache import LRUCache
+from .ratelimit import rate_limit
 
 bp = Blueprint('blog', __name__, url_prefix='/api/blog')
 
+# 帖子列表每页的默认条数与最大条数
+POSTS_PAGE_SIZE = 20
+POSTS_MAX_PAGE_SIZE = 100
+
+# 搜索结果每页的默认条数、最大条数，以及最多可以翻到的结果数
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+SEARCH_MAX_RESULTS = 1000
+
+# 全量导出帖子的限额，与 /stock/financial-data/export 共用 export 规则的令牌桶
+RATE_LIMIT_EXPORT = os.getenv('RATE_LIMIT_EXPORT', '5/60')
+
+# 帖子列表/详情响应缓存的容量与有效期（秒）
+# 缓存在进程内，增删改时精确失效；多进程部署时其他进程的缓存依靠有效期过期
+BLOG_CACHE_SIZE = int(os.getenv('BLOG_CACHE_SIZE', 1024))
+BLOG_CACHE_TTL = float(os.getenv('BLOG_CACHE_TTL', 60))
+
+# 键为 ('list', 游标, 每页条数) 或 ('post', 帖子ID)，
+# 值为 {'body': 序列化后的JSON, 'etag': 强ETag, 'post_ids': 响应中包含的帖子ID}
+blog_cache = LRUCache(maxsize=BLOG_CACHE_SIZE, ttl=BLOG_CACHE_TTL)
+# 缓存代数，每次失效时加一；构建期间代数变化说明读到的数据可能已被修改，不写入缓存
+_cache_generation = 0
+_cache_lock = threading.Lock()
+
+
+def cached_response(key, build):
+    """
+    返回缓存的JSON响应，支持 If-None-Match 条件请求（命中缓存且ETag一致时直接304，不访问数据库）
+    未命中时调用 build() 获取 (数据, 包含的帖子ID)，返回None表示资源不存在，不缓存
+    build() 期间发生过失效（并发的修改或删除）时，结果照常返回但不缓存，避免把旧数据缓存到过期
+    """
+    entry = blog_cache.get(key)
+    if entry is None:
+        generation = _cache_generation
+        built = build()
+        if built is None:
+            return None
+        payload, post_ids = built
+        body = current_app.json.response(payload).get_data()
+        entry = {
+            'body': body,
+            'etag': hashlib.sha1(body).hexdigest(),
+            'post_ids': frozenset(post_ids),
+        }
+        with _cache_lock:
+            if generation == _cache_generation:
+                blog_cache.set(key, entry)
+
+    response = current_app.response_class(entry['body'], mimetype='application/json')
+    response.set_etag(entry['etag'])
+    # 允许客户端缓存，但每次使用前都要用ETag重新验证
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+def _bump_generation():
+    """使正在构建中的响应不再写入缓存（调用方已持有 _cache_lock）"""
+    global _cache_generation
+    _cache_generation += 1
+
+
+def invalidate_post(post_id):
+    """帖子修改或删除后，删除它的详情缓存和包含它的列表页缓存"""
+    with _cache_lock:
+        _bump_generation()
+        blog_cache.invalidate_values(
+            lambda key, entry: key == ('post', post_id) or (key[0] == 'list' and post_id in entry['post_ids'])
+        )
+
+
+def invalidate_first_pages():
+    """新帖子总是出现在第一页，之后各页按游标定位，内容不受影响"""
+    with _cache_lock:
+        _bump_generation()
+        blog_cache.invalidate(lambda key: key[0] == 'list' and key[1] is None)
+
+
+def encode_cursor(post):
+    """把一页最后一条帖子的 (created, id) 编码为不透明的游标"""
+    raw = json.dumps([post['created'].isoformat(), post['id']])
+    return base64.urlsafe_b64encode(raw.encode('utf8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """解析游标，返回 (created, id)，格式不正确时抛出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created, post_id = json.loads(raw)
+        return datetime.datetime.fromisoformat(created), int(post_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError('无效的分页游标') from e
+
 
 @bp.route('/', methods=['GET'])
 def index():
-    """获取所有帖子列表"""
-    posts = db.query_db(
+    """
+    获取帖子列表，按 (created, id) 倒序游标分页：
+    ?limit= 每页条数，?cursor= 上一页返回的 next；返回 {'posts': [...], 'next': 下一页游标或null}
+    每页都是 idx_post_created_id 上的一次有界范围扫描，与翻到第几页无关
+    ?all=1 或请求NDJSON时等同于 /export（需要登录）
+    """
+    if request.args.get('all') == '1' or db.wants_ndjson():
+        return export()
+
+    try:
+        limit = int(request.args.get('limit', POSTS_PAGE_SIZE))
+        cursor = request.args.get('cursor')
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    limit = max(1, min(limit, POSTS_MAX_PAGE_SIZE))
+
+    def build():
+        query = (
+            'SELECT p.id, title, body, created, author_id, username'
+            ' FROM post p JOIN user u ON p.author_id = u.id'
+        )
+        args = []
+        if after is not None:
+            # 等价于 (created, id) < (%s, %s)，展开写法保证能用上复合索引的范围扫描
+            query += ' WHERE p.created < %s OR (p.created = %s AND p.id < %s)'
+            args = [after[0], after[0], after[1]]
+        # 多取一条用来判断是否还有下一页
+        query += ' ORDER BY p.created DESC, p.id DESC LIMIT %s'
+        args.append(limit + 1)
+
+        posts = db.query_db(query, args)
+        has_more = len(posts) > limit
+        posts = posts[:limit]
+        payload = {
+            'posts': posts,
+            'next': encode_cursor(posts[-1]) if has_more else None
+        }
+        return payload, [post['id'] for post in posts]
+
+    return cached_response(('list', cursor or None, limit), build)
+
+
+@bp.route('/export', methods=['GET'])
+@token_required
+@rate_limit('export', RATE_LIMIT_EXPORT)
+def export():
+    """
+    流式输出全部帖子（JSON数组，或请求NDJSON时每行一条）
+    导出期间占用一个数据库连接（请求本身的连接在输出前已归还），因此需要登录并限流
+    """
+    return db.streaming_response(
         'SELECT p.id, title, body, created, author_id, username'
         ' FROM post p JOIN user u ON p.author_id = u.id'
-        ' ORDER BY created DESC'
+        ' ORDER BY p.created DESC, p.id DESC',
+        ndjson=db.wants_ndjson()
     )
-    return jsonify(posts)
+
+
+@bp.route('/search', methods=['GET'])
+def search_posts():
+    """
+    全文搜索帖子：?q= 关键词，?page= 页码（从1开始），?limit= 每页条数
+    结果按相关度倒序，每条带 score；返回 {'posts', 'page', 'limit', 'has_more'}
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '请提供搜索关键词'}), 400
+
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        limit = max(1, min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': '无效的分页参数'}), 400
+
+    offset = (page - 1) * limit
+    if offset >= SEARCH_MAX_RESULTS:
+        return jsonify({'error': f'最多只能查看前 {SEARCH_MAX_RESULTS} 条结果'}), 400
+
+    # 多取一条用来判断是否还有下一页
+    posts = search.search_posts(query, limit + 1, offset)
+    has_more = len(posts) > limit and offset + limit < SEARCH_MAX_RESULTS
+    return jsonify({
+        'posts': posts[:limit],
+        'page': page,
+        'limit': limit,
+        'has_more': has_more,
+    })
 
 
 @bp.route('/<int:id>', methods=['GET'])
 def get_post_detail(id):
     """获取帖子详情"""
-    post = db.query_db(
-        'SELECT p.id, title, body, created, author_id, username'
-        ' FROM post p JOIN user u ON p.author_id = u.id'
-        ' WHERE p.id = %s',
-        (id,),
-        one=True
-    )
+    def build():
+        post = db.query_db(
+            'SELECT p.id, title, body, created, author_id, username'
+            ' FROM post p JOIN user u ON p.author_id = u.id'
+            ' WHERE p.id = %s',
+            (id,),
+            one=True
+        )
+        return (post, [id]) if post is not None else None
 
-    if post is None:
+    response = cached_response(('post', id), build)
+    if response is None:
         return jsonify({'error': 'Post not found'}), 404
 
     # # 获取评论
@@ -43,7 +227,7 @@ def get_post_detail(id):
     # )
     #
     # post['comments'] = comments
-    return jsonify(post)
+    return response
 
 
 @bp.route('/', methods=['POST'])
@@ -67,6 +251,9 @@ def create():
             ' VALUES (%s, %s, %s)',
             (title, body, g.user['id'])
         )
+        post_id = db.query_db('SELECT LAST_INSERT_ID() AS id', one=True)['id']
+        search.post_index.upsert(post_id, title, body)
+        invalidate_first_pages()
         return jsonify({'message': 'Post created successfully'}), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -93,6 +280,12 @@ def update(id):
             ' WHERE id = %s AND author_id = %s',
             (title, body, id, g.user['id'])
         )
+        # 本进程的内存搜索索引已建立时才需要同步（WHERE 条件可能未匹配，以数据库为准）
+        if search.post_index.is_built:
+            post = db.query_db('SELECT title, body FROM post WHERE id = %s', (id,), one=True)
+            if post is not None:
+                search.post_index.upsert(id, post['title'], post['body'])
+        invalidate_post(id)
         return jsonify({'message': 'Post updated successfully'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -107,6 +300,9 @@ def delete(id):
             'DELETE FROM post WHERE id = %s AND author_id = %s',
             (id, g.user['id'])
         )
+        if search.post_index.is_built and db.query_db('SELECT id FROM post WHERE id = %s', (id,), one=True) is None:
+            search.post_index.remove(id)
+        invalidate_post(id)
         return jsonify({'message': 'Post deleted successfully'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
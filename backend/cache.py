@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    线程安全的LRU缓存
+    - 超过 maxsize 时淘汰最久未使用的条目
+    - 条目可以设置过期时间（ttl秒），过期后视为未命中
+    - 条目可以带一个版本号，查询时版本不一致视为失效（用于数据变化后的失效判断）
+    - 记录命中/未命中/淘汰/失效次数，便于评估缓存大小
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, version, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None, version=_MISSING):
+        """查询缓存；提供 version 时只有版本一致的条目才算命中"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, item_version, expires_at = item
+                if expires_at is not None and expires_at <= time.monotonic():
+                    del self._data[key]
+                elif version is not _MISSING and version != item_version:
+                    del self._data[key]
+                    self.invalidations += 1
+                else:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value, version=None, ttl=None):
+        """写入缓存，ttl 默认使用缓存的全局设置"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, version, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """删除单个条目，返回是否存在"""
+        with self._lock:
+            if self._data.pop(key, None) is None:
+                return False
+            self.invalidations += 1
+            return True
+
+    def invalidate(self, predicate=None):
+        """删除满足 predicate(key) 的条目（不提供时清空），返回删除的条目数"""
+        with self._lock:
+            keys = [key for key in self._data if predicate is None or predicate(key)]
+            for key in keys:
+                del self._data[key]
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def invalidate_values(self, predicate):
+        """删除满足 predicate(key, value) 的条目，返回删除的条目数"""
+        with self._lock:
+            keys = [key for key, (value, _, _) in self._data.items() if predicate(key, value)]
+            for key in keys:
+                del self._data[key]
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
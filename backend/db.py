@@ -1,6 +1,9 @@
 import os
+import threading
+import time
+from collections import deque
 import click
-from flask import current_app, g
+from flask import current_app, g, jsonify, request, Response, stream_with_context
 from flask.cli import with_appcontext
 import MySQLdb
 from dotenv import load_dotenv
@@ -14,8 +17,227 @@ g 是一个特殊对象，独立于每一个请求。在处理请求过程中，
 可以多次使用， 而不用在同一个请求中每次调用 get_db 时都创建一个新的连接。
 
 current_app 是另一个特殊对象，该对象指向处理请求的 Flask 应用。 
+
+连接来自进程内的连接池：get_db 从池中借出连接，close_db 在上下文结束时归还，
+避免每个请求都重新建立TCP连接和认证
 '''
 
+# 连接池最少保持的连接数（首次使用时预先建立）
+MYSQL_POOL_MIN_SIZE = int(os.getenv('MYSQL_POOL_MIN_SIZE', 1))
+# 连接池最多的连接数
+MYSQL_POOL_MAX_SIZE = int(os.getenv('MYSQL_POOL_MAX_SIZE', 10))
+# 连接池耗尽时等待可用连接的最长时间（秒）
+MYSQL_POOL_TIMEOUT = float(os.getenv('MYSQL_POOL_TIMEOUT', 10))
+# 连接建立超过该时间（秒）后关闭重建，应小于MySQL的 wait_timeout
+MYSQL_POOL_RECYCLE = float(os.getenv('MYSQL_POOL_RECYCLE', 3600))
+# 连接空闲超过该时间（秒）后，借出前先 ping 检查是否可用
+MYSQL_POOL_PING_AFTER = float(os.getenv('MYSQL_POOL_PING_AFTER', 30))
+# iter_query 每次从服务端读取的行数
+ITER_QUERY_FETCH_SIZE = int(os.getenv('ITER_QUERY_FETCH_SIZE', 1000))
+
+
+class PoolTimeoutError(Exception):
+    """等待可用连接超时"""
+
+
+def connect():
+    """新建一个数据库连接"""
+    db = MySQLdb.connect(
+        host=os.getenv('MYSQL_HOST', 'localhost'),
+        user=os.getenv('MYSQL_USER', 'root'),
+        password=os.getenv('MYSQL_PASSWORD', 'nwx2698199'),
+        database=os.getenv('MYSQL_DATABASE', 'flask_forum'),
+        charset='utf8mb4'
+    )
+    db.autocommit(True)
+    return db
+
+
+class ConnectionPool:
+    """
+    线程安全的数据库连接池
+    - 借出时复用空闲连接，建立超过 recycle 秒的连接会被关闭重建，
+      空闲超过 ping_after 秒的连接先 ping 检查，失效则重建
+    - 连接数达到 max_size 后，借用者最多等待 timeout 秒，超时抛出 PoolTimeoutError
+    - 进程 fork 后（如 gunicorn --preload）自动丢弃从父进程继承的连接
+    """
+
+    def __init__(self, connect, min_size=MYSQL_POOL_MIN_SIZE, max_size=MYSQL_POOL_MAX_SIZE,
+                 timeout=MYSQL_POOL_TIMEOUT, recycle=MYSQL_POOL_RECYCLE, ping_after=MYSQL_POOL_PING_AFTER):
+        self._connect = connect
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = deque()  # (连接, 归还时间)，后进先出
+        self._created_at = {}  # id(连接) -> 建立时间，包含借出中的连接
+        self._size = 0
+        self._waiters = 0
+        self._warmed = False
+        self.checkouts = 0
+        self.timeouts = 0
+        self.created = 0
+        self.recycled = 0
+        self.ping_failures = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # 父进程的连接不能在子进程中使用，直接丢弃（不关闭，避免影响父进程）
+            self._reset()
+
+    def _new_connection(self):
+        conn = self._connect()
+        with self._lock:
+            self._created_at[id(conn)] = time.monotonic()
+            self.created += 1
+        return conn
+
+    def _discard(self, conn):
+        """关闭连接并释放其占用的名额（调用方已持有锁）"""
+        self._created_at.pop(id(conn), None)
+        self._size -= 1
+        self._available.notify()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _warm_up(self):
+        """首次使用时预先建立 min_size 个连接"""
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+            count = max(self.min_size - self._size, 0)
+            self._size += count
+        for _ in range(count):
+            try:
+                conn = self._new_connection()
+            except Exception as e:
+                print(f"预先建立数据库连接失败: {e}")
+                with self._lock:
+                    self._size -= 1
+                continue
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+                self._available.notify()
+
+    def acquire(self):
+        """借出一个可用连接"""
+        self._check_pid()
+        if not self._warmed:
+            self._warm_up()
+
+        started = time.monotonic()
+        with self._lock:
+            while True:
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # 先占用名额，在锁外建立连接
+                    self._size += 1
+                    conn = None
+                    break
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeoutError(f'等待数据库连接超时（{self.timeout}秒，连接池上限 {self.max_size}）')
+                self._waiters += 1
+                try:
+                    self._available.wait(remaining)
+                finally:
+                    self._waiters -= 1
+
+            waited = time.monotonic() - started
+            self.checkouts += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+        if conn is None:
+            try:
+                return self._new_connection()
+            except Exception:
+                with self._lock:
+                    self._size -= 1
+                    self._available.notify()
+                raise
+
+        return self._validate(conn, returned_at)
+
+    def _validate(self, conn, returned_at):
+        """检查空闲连接：过老的重建，空闲太久的先 ping"""
+        now = time.monotonic()
+        created_at = self._created_at.get(id(conn), now)
+        healthy = True
+        if now - created_at > self.recycle:
+            self.recycled += 1
+            healthy = False
+        elif now - returned_at > self.ping_after:
+            try:
+                conn.ping()
+            except Exception:
+                self.ping_failures += 1
+                healthy = False
+
+        if healthy:
+            return conn
+
+        with self._lock:
+            self._discard(conn)
+            # 名额仍归当前借用者
+            self._size += 1
+        try:
+            return self._new_connection()
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._available.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        """归还连接；discard 为True或连接已关闭时直接关闭，不再复用"""
+        with self._lock:
+            if self._pid != os.getpid() or id(conn) not in self._created_at:
+                # 不属于当前连接池（如 fork 前借出的连接）
+                return
+            if discard or not getattr(conn, 'open', True):
+                self._discard(conn)
+                return
+            self._idle.append((conn, time.monotonic()))
+            self._available.notify()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'waiters': self._waiters,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'created': self.created,
+                'recycled': self.recycled,
+                'ping_failures': self.ping_failures,
+                'total_wait_ms': round(self.total_wait * 1000, 1),
+                'avg_wait_ms': round(self.total_wait * 1000 / self.checkouts, 3) if self.checkouts else 0,
+                'max_wait_ms': round(self.max_wait * 1000, 1),
+            }
+
+
+pool = ConnectionPool(connect)
+
 
 def init_db():
     '''
@@ -38,14 +260,7 @@ def init_db_command():
 
 def get_db():  # 连接数据库
     if 'db' not in g:  # g.db类似一个全局变量
-        g.db = MySQLdb.connect(
-            host=os.getenv('MYSQL_HOST', 'localhost'),
-            user=os.getenv('MYSQL_USER', 'root'),
-            password=os.getenv('MYSQL_PASSWORD', 'nwx2698199'),
-            database=os.getenv('MYSQL_DATABASE', 'flask_forum'),
-            charset='utf8mb4'
-        )
-        g.db.autocommit(True)
+        g.db = pool.acquire()  # 从连接池借出连接
     return g.db
 
 
@@ -53,7 +268,13 @@ def close_db(e=None):
     db = g.pop('db', None)  # 取得g中的db
 
     if db is not None:
-        db.close()  # 关闭数据库连接
+        # 把连接归还连接池，执行中出现连接错误的连接直接关闭
+        pool.release(db, discard=g.pop('db_broken', False))
+
+
+def pool_stats():
+    """连接池指标"""
+    return jsonify({'success': True, 'pool': pool.stats()})
 
 
 def init_app(app):
@@ -67,13 +288,97 @@ def init_app(app):
     这行代码向 Flask 的命令行接口（CLI）添加了一个新的命令
     允许你通过命令行来初始化数据库
     '''
+    from . import financials
+    app.cli.add_command(financials.ingest_financials_command)
+
+    # 与其他统计接口一样需要登录；auth 模块导入了本模块，因此在这里导入
+    from .auth import token_required
+    app.add_url_rule('/api/db/pool', 'db_pool_stats', token_required(pool_stats))
 
 
 def query_db(query, args=(), one=False):
     """执行查询并返回结果"""
     db = get_db()
     cursor = db.cursor(MySQLdb.cursors.DictCursor)
-    cursor.execute(query, args)
-    rv = cursor.fetchall()
-    cursor.close()
+    try:
+        cursor.execute(query, args)
+        rv = cursor.fetchall()
+    except MySQLdb.OperationalError:
+        g.db_broken = True  # 连接可能已断开，归还时不再复用
+        raise
+    finally:
+        # 出错时也要关闭游标，连接归还连接池后还会被复用
+        cursor.close()
     return (rv[0] if rv else None) if one else rv
+
+
+def iter_query(query, args=(), chunk_size=None):
+    """
+    流式执行查询：使用服务端游标（SSDictCursor），边读边产出，不把整个结果集放进内存
+    chunk_size 为空时逐行产出字典，否则每次产出最多 chunk_size 行的列表
+    使用单独从连接池借出的连接，不占用 get_db 的连接，迭代过程中仍可以执行其他查询；
+    生成器第一次迭代时才执行查询，读完或关闭生成器后归还连接
+    """
+    fetch_size = chunk_size or ITER_QUERY_FETCH_SIZE
+    conn = pool.acquire()
+    finished = False
+    try:
+        cursor = conn.cursor(MySQLdb.cursors.SSDictCursor)
+        cursor.execute(query, args)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            if chunk_size:
+                yield list(rows)
+            else:
+                yield from rows
+        cursor.close()
+        finished = True
+    finally:
+        # 结果集没有读完（中途出错或客户端断开）时，需要读完剩余数据才能复用连接，直接关闭更快
+        pool.release(conn, discard=not finished)
+
+
+def _dumps(row):
+    # 与 jsonify 使用同样的序列化规则（如日期格式）
+    return current_app.json.dumps(row)
+
+
+def stream_json_array(chunks):
+    """把 iter_query(chunk_size=...) 产出的分块编码为一个JSON数组的片段"""
+    yield '['
+    first = True
+    for rows in chunks:
+        if not rows:
+            continue
+        yield ('' if first else ',') + ','.join(_dumps(row) for row in rows)
+        first = False
+    yield ']'
+
+
+def stream_ndjson(chunks):
+    """把 iter_query(chunk_size=...) 产出的分块编码为NDJSON（每行一个JSON对象）"""
+    for rows in chunks:
+        if rows:
+            yield ''.join(_dumps(row) + '\n' for row in rows)
+
+
+def streaming_response(query, args=(), ndjson=False, chunk_size=ITER_QUERY_FETCH_SIZE):
+    """
+    把查询结果流式写入响应：默认为JSON数组（与 jsonify(query_db(...)) 的结果相同），
+    ndjson 为True时为 application/x-ndjson；内存占用与结果集大小无关
+    流式输出前先把请求的连接（g.db，如 token_required 查询用户时借出的）归还连接池，
+    输出期间只占用 iter_query 借出的一个连接
+    """
+    close_db()
+    chunks = iter_query(query, args, chunk_size=chunk_size)
+    if ndjson:
+        return Response(stream_with_context(stream_ndjson(chunks)), mimetype='application/x-ndjson')
+    return Response(stream_with_context(stream_json_array(chunks)), mimetype='application/json')
+
+
+def wants_ndjson():
+    """客户端通过 ?format=ndjson 或 Accept: application/x-ndjson 请求NDJSON"""
+    return (request.args.get('format') == 'ndjson'
+            or request.accept_mimetypes.best == 'application/x-ndjson')
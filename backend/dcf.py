@@ -0,0 +1,107 @@
+import numpy as np
+
+'''
+向量化的多阶段DCF引擎
+每个阶段的现值都是等比数列求和，可以用闭式公式一次算出：
+    sum_{k=1..n} F * q^k = F * q * (1 - q^n) / (1 - q),  q = (1 + g) / (1 + r)
+所有参数都可以是NumPy数组，按广播规则一次计算出全部组合的企业价值
+'''
+
+
+def _geometric_sum(q, n):
+    """sum_{k=1..n} q^k，q 接近1时退化为 n"""
+    near_one = np.isclose(q, 1.0, rtol=0, atol=1e-12)
+    safe_denominator = np.where(near_one, 1.0, 1.0 - q)
+    return np.where(near_one, n, q * (1.0 - q ** n) / safe_denominator)
+
+
+def enterprise_values(fcf, discount_rate, stage1_years=5, stage1_growth=0.1,
+                      stage2_years=5, stage2_growth=0.05, stage3_years=0, stage3_growth=0.02):
+    """
+    批量计算三阶段DCF企业价值，参数含义与 DCFValuation.common_dcf 相同
+    参数可以是标量或可广播的数组，返回广播后形状的数组
+    stage3_years 为0时第三阶段按永续增长计算终值；折现率等于永续增长率时结果为inf/nan
+    """
+    fcf = np.asarray(fcf, dtype=float)
+    r = np.asarray(discount_rate, dtype=float)
+    g1 = np.asarray(stage1_growth, dtype=float)
+    g2 = np.asarray(stage2_growth, dtype=float)
+    g3 = np.asarray(stage3_growth, dtype=float)
+    years1 = np.asarray(stage1_years, dtype=float)
+    years2 = np.asarray(stage2_years, dtype=float)
+    years3 = np.asarray(stage3_years, dtype=float)
+    perpetual = years3 == 0
+    # 年数为负时与逐年循环一致：该阶段没有现金流，但年份编号（折现指数）仍按原值累加
+    n1 = np.maximum(years1, 0)
+    n2 = np.maximum(years2, 0)
+    n3 = np.maximum(years3, 0)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        growth = 1.0 + r
+
+        # 第一阶段：高增长期
+        stage1_pv = fcf * _geometric_sum((1.0 + g1) / growth, n1)
+        # 第一阶段结束时的现金流及其折现因子
+        fcf1 = fcf * (1.0 + g1) ** n1
+        discount1 = growth ** years1
+
+        # 第二阶段：中期增长
+        stage2_pv = fcf1 / discount1 * _geometric_sum((1.0 + g2) / growth, n2)
+        fcf2 = fcf1 * (1.0 + g2) ** n2
+        discount2 = discount1 * growth ** years2
+
+        # 第三阶段：永续增长（终值按第 n1+n2 年折现）或有限期增长
+        terminal_pv = fcf2 * (1.0 + g3) / (r - g3) / discount2
+        stage3_pv = fcf2 / discount2 * _geometric_sum((1.0 + g3) / growth, n3)
+
+        return stage1_pv + stage2_pv + np.where(perpetual, terminal_pv, stage3_pv)
+
+
+def to_rounded_list(values, digits=2):
+    """把数组转换为可JSON序列化的嵌套列表，非有限值（inf/nan）转换为None"""
+    values = np.asarray(values, dtype=float)
+    rounded = np.round(values, digits).astype(object)
+    rounded[~np.isfinite(values)] = None
+    return rounded.tolist()
+
+
+# 蒙特卡洛结果汇总的分位数
+PERCENTILES = (1, 5, 10, 25, 50, 75, 90, 95, 99)
+
+
+def sample(rng, spec, size):
+    """
+    按分布描述抽样，spec 可以是：
+    数字（常数）、{'dist': 'normal', 'mean', 'std'}、{'dist': 'uniform', 'low', 'high'}、
+    {'dist': 'triangular', 'low', 'mode', 'high'}、{'dist': 'lognormal', 'mean', 'sigma'}
+    """
+    if isinstance(spec, (int, float)):
+        return np.full(size, float(spec))
+
+    dist = spec.get('dist', 'normal')
+    if dist == 'normal':
+        return rng.normal(float(spec['mean']), float(spec['std']), size)
+    if dist == 'uniform':
+        return rng.uniform(float(spec['low']), float(spec['high']), size)
+    if dist == 'triangular':
+        return rng.triangular(float(spec['low']), float(spec['mode']), float(spec['high']), size)
+    if dist == 'lognormal':
+        return rng.lognormal(float(spec['mean']), float(spec['sigma']), size)
+    raise ValueError(f'不支持的分布: {dist}')
+
+
+def summarize_distribution(values, reference, bins=50, digits=2):
+    """汇总模拟结果：均值、标准差、分位数、直方图，以及高于参考值（当前价格）的概率"""
+    percentiles = np.percentile(values, PERCENTILES)
+    # 直方图范围取1%~99%分位数，避免极端值把分布挤进少数几个桶
+    counts, edges = np.histogram(values, bins=bins, range=(percentiles[0], percentiles[-1]))
+    return {
+        'mean': round(float(values.mean()), digits),
+        'std': round(float(values.std()), digits),
+        'percentiles': {f'p{p}': round(float(v), digits) for p, v in zip(PERCENTILES, percentiles)},
+        'histogram': {
+            'bin_edges': [round(float(edge), digits) for edge in edges],
+            'counts': counts.tolist(),
+        },
+        'prob_above_reference': round(float((values > reference).mean()), 4),
+    }
@@ -20,6 +20,15 @@ CREATE TABLE IF NOT EXISTS financial_data (
     INDEX idx_report_year (report_year)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='股票财务数据表';
 
+-- 创建总股本表（由估值服务根据行情快照定期批量刷新）
+CREATE TABLE IF NOT EXISTS stock_shares (
+    stock_code VARCHAR(10) NOT NULL PRIMARY KEY COMMENT '股票代码',
+    total_shares BIGINT NOT NULL COMMENT '总股本（股）',
+    effective_date DATE NOT NULL COMMENT '股本生效日期',
+    source VARCHAR(32) NOT NULL COMMENT '数据来源',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间'
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='股票总股本表';
+
 -- 插入示例数据（平安银行 000001）
 INSERT INTO financial_data (stock_code, company_name, report_year, report_date, net_income, interest_expense, depreciation, capex, current_assets, current_liabilities, total_shares) VALUES
 ('000001', '平安银行', 2024, '2024-12-31', 43200000000, 16000000000, 9000000000, 12800000000, 380000000000, 300000000000, 19405918198),
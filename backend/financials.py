@@ -0,0 +1,203 @@
+import os
+import json
+import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from . import db
+
+# 是否把从AKShare获取的财务数据写回 financial_data 表
+FINANCIAL_DATA_WRITE_THROUGH = os.getenv('FINANCIAL_DATA_WRITE_THROUGH', '1') == '1'
+# financial_data 中数据的最长有效期（天），超过后估值时会重新从AKShare获取
+FINANCIAL_DATA_MAX_AGE_DAYS = float(os.getenv('FINANCIAL_DATA_MAX_AGE_DAYS', 90))
+
+FINANCIAL_COLUMNS = (
+    'stock_code', 'company_name', 'report_year', 'report_date',
+    'net_income', 'interest_expense', 'depreciation', 'capex',
+    'current_assets', 'current_liabilities', 'total_shares',
+)
+
+# 按 unique_stock_year 更新已有记录，并显式刷新 updated_at 作为数据新鲜度时间
+# （数值没有变化时 ON UPDATE CURRENT_TIMESTAMP 不会生效）
+UPSERT_SUFFIX = (
+    ' ON DUPLICATE KEY UPDATE'
+    ' company_name = VALUES(company_name),'
+    ' report_date = VALUES(report_date),'
+    ' net_income = VALUES(net_income),'
+    ' interest_expense = VALUES(interest_expense),'
+    ' depreciation = VALUES(depreciation),'
+    ' capex = VALUES(capex),'
+    ' current_assets = VALUES(current_assets),'
+    ' current_liabilities = VALUES(current_liabilities),'
+    ' total_shares = IF(VALUES(total_shares) > 0, VALUES(total_shares), total_shares),'
+    ' updated_at = CURRENT_TIMESTAMP'
+)
+
+
+def valid_company_name(name):
+    """公司名称为空或NaN（来自 DataFrame 的缺失值）时返回None"""
+    import pandas as pd
+
+    if name is None or not pd.notna(name):
+        return None
+    return str(name).strip() or None
+
+
+def normalize_financial_data(stock_code, company_name, financial_data):
+    """
+    把 get_financial_data_from_akshare 返回的年度数据转换为 financial_data 表的行
+    无法解析报告日期的年份会被跳过
+    """
+    company_name = valid_company_name(company_name) or stock_code
+    rows = []
+    for year_data in financial_data:
+        report_date = str(year_data.get('year') or '')[:10]
+        try:
+            report_date = datetime.datetime.strptime(report_date, '%Y-%m-%d').date()
+        except ValueError:
+            print(f"无法解析报告日期: {year_data.get('year')}，跳过该年数据")
+            continue
+
+        rows.append((
+            stock_code,
+            company_name,
+            report_date.year,
+            report_date,
+            round(year_data.get('net_income', 0), 2),
+            round(year_data.get('interest_expense', 0), 2),
+            round(year_data.get('depreciation', 0), 2),
+            round(abs(year_data.get('capex', 0)), 2),
+            round(year_data.get('current_assets', 0), 2),
+            round(year_data.get('current_liabilities', 0), 2),
+            int(year_data.get('total_shares', 0) or 0),
+        ))
+    return rows
+
+
+def upsert_financial_rows(rows):
+    """用一条多行 INSERT ... ON DUPLICATE KEY UPDATE 写入财务数据，返回写入的行数"""
+    if not rows:
+        return 0
+
+    placeholders = '(' + ', '.join(['%s'] * len(FINANCIAL_COLUMNS)) + ')'
+    query = (
+        f'INSERT INTO financial_data ({", ".join(FINANCIAL_COLUMNS)}) VALUES '
+        + ', '.join([placeholders] * len(rows))
+        + UPSERT_SUFFIX
+    )
+    args = [value for row in rows for value in row]
+    db.query_db(query, args)
+    return len(rows)
+
+
+def save_financial_data(stock_code, company_name, financial_data):
+    """把单只股票的财务数据写回数据库"""
+    rows = normalize_financial_data(stock_code, company_name, financial_data)
+    count = upsert_financial_rows(rows)
+    print(f"已写入股票 {stock_code} 的 {count} 年财务数据")
+    return count
+
+
+def is_stale(updated_at, max_age_days=FINANCIAL_DATA_MAX_AGE_DAYS):
+    """判断数据库中的财务数据是否超过有效期"""
+    if updated_at is None:
+        return True
+    return datetime.datetime.now() - updated_at > datetime.timedelta(days=max_age_days)
+
+
+def _load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding='utf8') as f:
+        return set(json.load(f).get('done', []))
+
+
+def _save_checkpoint(path, done):
+    # 先写临时文件再替换，避免中断时留下损坏的检查点
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump({'done': sorted(done), 'saved_at': datetime.datetime.now().isoformat()}, f)
+    os.replace(tmp_path, path)
+
+
+def ingest_financials(stocks, checkpoint_path, workers=8, batch_size=500):
+    """
+    批量抓取 stocks（[(代码, 名称), ...]）的财务报表并写入 financial_data
+    - 最多 workers 只股票同时抓取
+    - 累计 batch_size 行后用一条多行upsert写入，并更新检查点
+    - 已写入的股票记录在检查点文件中，中断后再次运行会跳过它们
+    返回 (写入的股票数, 写入的行数, 失败的股票代码列表)
+    """
+    from .stock import get_financial_data_from_akshare
+
+    done = _load_checkpoint(checkpoint_path)
+    pending = [(code, name) for code, name in stocks if code not in done]
+    click.echo(f'共 {len(stocks)} 只股票，已完成 {len(stocks) - len(pending)} 只，待抓取 {len(pending)} 只')
+
+    buffer = []
+    buffered_codes = []
+    failed = []
+    written_rows = 0
+
+    def flush():
+        nonlocal written_rows
+        written_rows += upsert_financial_rows(buffer)
+        done.update(buffered_codes)
+        _save_checkpoint(checkpoint_path, done)
+        buffer.clear()
+        buffered_codes.clear()
+
+    # 每只股票的三张报表并发获取，因此报表线程池为 workers 的3倍
+    with ThreadPoolExecutor(max_workers=workers * 3, thread_name_prefix='ingest-statement') as statement_pool, \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest') as pool:
+        futures = {
+            # 绕过线上请求共用的熔断器，大量无数据的代码不会让整个站点的报表请求熔断
+            pool.submit(get_financial_data_from_akshare, code, statement_pool, True): (code, name)
+            for code, name in pending
+        }
+        for i, future in enumerate(as_completed(futures), 1):
+            code, name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'success': False, 'message': str(e)}
+
+            # 备用方法生成的估算数据（带note）不入库
+            if result['success'] and not result.get('note'):
+                rows = normalize_financial_data(code, valid_company_name(result.get('company_name')) or name,
+                                                result['data'])
+                buffer.extend(rows)
+                buffered_codes.append(code)
+                if len(buffer) >= batch_size:
+                    flush()
+            else:
+                failed.append(code)
+
+            if i % 100 == 0:
+                click.echo(f'进度: {i}/{len(pending)}，失败 {len(failed)} 只')
+
+        if buffer:
+            flush()
+
+    return len(done), written_rows, failed
+
+
+@click.command('ingest-financials')
+@click.option('--workers', default=8, show_default=True, help='同时抓取的股票数')
+@click.option('--batch-size', default=500, show_default=True, help='每条upsert语句写入的行数')
+@click.option('--checkpoint', default=None, help='检查点文件路径，默认在instance目录下')
+@click.option('--restart', is_flag=True, help='忽略已有检查点，从头抓取')
+@with_appcontext
+def ingest_financials_command(workers, batch_size, checkpoint, restart):
+    """Crawl statements for the whole A-share universe into financial_data."""
+    from .market import stock_directory
+
+    checkpoint = checkpoint or os.path.join(current_app.instance_path, 'ingest_financials.json')
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    done_count, written_rows, failed = ingest_financials(
+        stock_directory.listing(), checkpoint, workers=workers, batch_size=batch_size
+    )
+    click.echo(f'财务数据导入完成：累计 {done_count} 只股票，本次写入 {written_rows} 行，失败 {len(failed)} 只')
@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+后台任务
+耗时的请求（如冷启动的估值）提交到有界线程池中执行，接口立即返回任务ID，
+客户端再按ID轮询任务状态和结果，避免长时间占用WSGI工作线程
+任务状态保存在可替换的 JobStore 中，默认保存在进程内存里
+'''
+
+# 同时执行的后台任务数
+JOB_MAX_WORKERS = int(os.getenv('JOB_MAX_WORKERS', 4))
+# 排队（含执行中）任务数上限，超过后拒绝提交
+JOB_MAX_PENDING = int(os.getenv('JOB_MAX_PENDING', 100))
+# 已结束任务的保留时间（秒），过期后查询不到
+JOB_RESULT_TTL = float(os.getenv('JOB_RESULT_TTL', 3600))
+
+# 任务状态
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class JobQueueFullError(Exception):
+    """排队的任务数已达上限"""
+
+
+class JobStore(ABC):
+    """
+    任务状态存储接口
+    任务是一个可JSON序列化的字典：
+    {'id', 'kind', 'owner_id', 'status', 'created_at', 'started_at', 'finished_at', 'result', 'error'}
+    多进程部署时可以实现基于数据库或Redis的存储，使任意进程都能查询到任务
+    """
+
+    @abstractmethod
+    def create(self, job):
+        ...
+
+    @abstractmethod
+    def update(self, job_id, **fields):
+        ...
+
+    @abstractmethod
+    def get(self, job_id):
+        """返回任务字典的副本，不存在或已过期时返回None"""
+
+
+class InMemoryJobStore(JobStore):
+    """进程内的任务存储，已结束的任务保留 ttl 秒"""
+
+    def __init__(self, ttl=JOB_RESULT_TTL):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _prune(self):
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job['finished_at'] is not None and now - job['finished_at'] > self.ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def create(self, job):
+        with self._lock:
+            self._prune()
+            self._jobs[job['id']] = dict(job)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job['finished_at'] is not None and time.time() - job['finished_at'] > self.ttl:
+                del self._jobs[job_id]
+                return None
+            return dict(job)
+
+
+class JobRunner:
+    """
+    在有界线程池中执行任务，并把状态写入 store
+    任务函数在 Flask 应用上下文中执行，可以正常使用 db.get_db 等依赖 g 的函数
+    """
+
+    def __init__(self, store=None, max_workers=JOB_MAX_WORKERS, max_pending=JOB_MAX_PENDING):
+        self.store = store or InMemoryJobStore()
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+
+    def submit(self, app, kind, fn, *args, owner_id=None, **kwargs):
+        """
+        提交任务，返回任务字典
+        fn 的返回值作为任务结果（需可JSON序列化），抛出的异常作为任务错误
+        owner_id 为提交任务的用户ID，查询时用于校验任务归属
+        排队任务数达到上限时抛出 JobQueueFullError
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise JobQueueFullError(f'排队任务已达上限 {self.max_pending}')
+            self._pending += 1
+            self.submitted += 1
+
+        job = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'owner_id': owner_id,
+            'status': PENDING,
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+            'error': None,
+        }
+        self.store.create(job)
+        try:
+            self._executor.submit(self._run, app, job['id'], fn, args, kwargs)
+        except Exception:
+            self._release()
+            raise
+        return job
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def _run(self, app, job_id, fn, args, kwargs):
+        self.store.update(job_id, status=RUNNING, started_at=time.time())
+        try:
+            with app.app_context():
+                result = fn(*args, **kwargs)
+        except Exception as e:
+            print(f"后台任务 {job_id} 执行失败: {e}")
+            self.store.update(job_id, status=FAILED, error=str(e), finished_at=time.time())
+        else:
+            self.store.update(job_id, status=SUCCEEDED, result=result, finished_at=time.time())
+        finally:
+            self._release()
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': self._pending,
+                'max_pending': self.max_pending,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+            }
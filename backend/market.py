@@ -0,0 +1,424 @@
+import os
+import math
+import datetime
+import threading
+import time
+
+from . import db, upstream
+
+# 行情快照后台刷新间隔（秒）
+SNAPSHOT_INTERVAL = float(os.getenv('MARKET_SNAPSHOT_INTERVAL', 30))
+# 行情快照允许的最大陈旧时间（秒），超过后在请求中同步刷新；刷新失败时继续使用旧快照并标记为旧数据
+SNAPSHOT_MAX_AGE = float(os.getenv('MARKET_SNAPSHOT_MAX_AGE', 300))
+# 刷新行情快照时等待上游的最长时间（秒），也是从未加载过快照时请求等待刷新的最长时间
+SNAPSHOT_REFRESH_TIMEOUT = float(os.getenv('MARKET_SNAPSHOT_REFRESH_TIMEOUT', 10))
+# 股票代码/名称目录的刷新周期（秒）
+DIRECTORY_TTL = float(os.getenv('STOCK_DIRECTORY_TTL', 86400))
+# 总股本后台批量刷新周期（秒）
+SHARE_REFRESH_INTERVAL = float(os.getenv('SHARE_REFRESH_INTERVAL', 86400))
+# 总股本批量写入数据库时每条语句的行数
+SHARE_UPSERT_BATCH = 1000
+# 行情快照对应的上游函数
+SNAPSHOT_UPSTREAM = 'stock_zh_a_spot_em'
+
+
+class QuoteSnapshot:
+    """
+    全市场A股行情快照
+    后台线程定期调用 ak.stock_zh_a_spot_em() 下载整张行情表，
+    按股票代码建立字典索引，各请求共享同一份快照，按代码O(1)查询
+    上游故障（含熔断打开）期间继续提供最近一次成功的快照，并返回其真实年龄
+    """
+
+    def __init__(self, interval=SNAPSHOT_INTERVAL, max_age=SNAPSHOT_MAX_AGE, refresh_timeout=SNAPSHOT_REFRESH_TIMEOUT):
+        self.interval = interval
+        self.max_age = max_age
+        self.refresh_timeout = refresh_timeout
+        # (按代码索引的行情, 快照时间)，整体替换保证读取时的一致性
+        self._snapshot = ({}, 0.0)
+        self._refresh_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    def refresh(self):
+        """下载整张行情表并替换当前快照"""
+        # 只接受新数据，避免把上游返回的旧数据当作新快照
+        spot = upstream.call(SNAPSHOT_UPSTREAM, stale_ok=False, wait_seconds=self.refresh_timeout)
+        if spot is None or spot.empty:
+            raise ValueError('市场数据API返回空')
+
+        quotes = {str(row['代码']): row for row in spot.to_dict('records')}
+        self._snapshot = (quotes, time.time())
+        print(f"行情快照已刷新，共 {len(quotes)} 只股票")
+
+    def start(self):
+        """启动后台刷新线程（每个进程只启动一次）"""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='quote-snapshot', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self._refresh_lock:
+                    self.refresh()
+            except Exception as e:
+                print(f"后台刷新行情快照失败: {e}")
+            time.sleep(self.interval)
+
+    @property
+    def updated_at(self):
+        """当前快照的生成时间（从未加载时为0），可作为快照版本号"""
+        return self._snapshot[1]
+
+    def age(self):
+        """当前快照的年龄（秒），从未加载时返回None"""
+        updated_at = self._snapshot[1]
+        return time.time() - updated_at if updated_at else None
+
+    def _ensure_fresh(self):
+        """
+        快照过期时在请求中刷新（最多等待 refresh_timeout 秒）
+        已有其他线程在刷新时不排队：有旧快照就直接使用旧快照，从未加载过时最多等待 refresh_timeout 秒
+        """
+        age = self.age()
+        if age is not None and age <= self.max_age:
+            return
+        if not self._refresh_lock.acquire(timeout=self.refresh_timeout if age is None else 0):
+            return
+        try:
+            # 等锁期间可能已被其他线程刷新
+            age = self.age()
+            if age is None or age > self.max_age:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"同步刷新行情快照失败: {e}")
+        finally:
+            self._refresh_lock.release()
+
+    def _current(self):
+        """
+        返回 (按代码索引的行情, 快照年龄秒数)；从未加载成功时行情为空
+        快照超过 max_age 且刷新失败时返回旧快照，并把本次请求标记为使用了旧数据
+        """
+        self.start()
+        self._ensure_fresh()
+
+        quotes, updated_at = self._snapshot
+        if not updated_at:
+            return {}, None
+
+        age = time.time() - updated_at
+        if age > self.max_age:
+            upstream.mark_stale(SNAPSHOT_UPSTREAM)
+        return quotes, age
+
+    def get(self, stock_code):
+        """
+        按股票代码查询行情
+        返回 (行情字典, 快照年龄秒数)；快照从未加载成功或没有该股票时行情为None
+        """
+        quotes, age = self._current()
+        return quotes.get(stock_code), age
+
+    def get_many(self, stock_codes):
+        """从同一份快照中查询多只股票，返回 ({代码: 行情字典}, 快照年龄秒数)"""
+        quotes, age = self._current()
+        return {code: quotes[code] for code in stock_codes if code in quotes}, age
+
+    def get_all(self):
+        """返回整份快照 ({代码: 行情字典}, 快照年龄秒数)"""
+        return self._current()
+
+
+def _to_float(value):
+    """转换为float，空值/NaN/无法解析时返回None"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(value) else value
+
+
+def shares_from_quote(quote):
+    """用行情快照中的 总市值 / 最新价 推算总股本，无法推算时返回0"""
+    if quote is None:
+        return 0
+    market_cap = _to_float(quote.get('总市值'))
+    price = _to_float(quote.get('最新价'))
+    if market_cap and price and price > 0:
+        return market_cap / price
+    return 0
+
+
+# 进程内共享的行情快照
+quote_snapshot = QuoteSnapshot()
+
+
+class ShareStore:
+    """
+    总股本存储
+    内存中按代码索引，持久化在 stock_shares 表中（带生效日期和来源），
+    后台线程定期用行情快照中的 总市值 / 最新价 批量刷新全部股票的总股本
+    数据库不可用（如没有 stock_shares 表）时只使用内存，加载和写入失败都会计数并告警
+    """
+
+    def __init__(self, snapshot, interval=SHARE_REFRESH_INTERVAL):
+        self.snapshot = snapshot
+        self.interval = interval
+        self._shares = None  # 代码 -> {'total_shares', 'effective_date', 'source', 'updated_at'}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.load_error = None
+        self.save_failures = 0
+        self.last_save_error = None
+
+    def _load(self):
+        """从 stock_shares 表加载全部股本到内存"""
+        rows = db.query_db('SELECT stock_code, total_shares, effective_date, source, updated_at FROM stock_shares')
+        self._shares = {
+            row['stock_code']: {
+                'total_shares': int(row['total_shares']),
+                'effective_date': row['effective_date'],
+                'source': row['source'],
+                'updated_at': row['updated_at'],
+            }
+            for row in rows
+        }
+        print(f"从数据库加载了 {len(self._shares)} 只股票的总股本")
+
+    def _ensure_loaded(self):
+        """首次使用时从数据库加载（后台线程和请求线程只会有一个真正加载）；失败时改为只使用内存"""
+        if self._shares is None:
+            with self._lock:
+                if self._shares is None:
+                    try:
+                        self._load()
+                    except Exception as e:
+                        self.load_error = str(e)
+                        self._shares = {}
+                        print(f"警告: 加载总股本失败，本进程只在内存中保存总股本: {e}")
+
+    def _persist(self, records):
+        """写入数据库，失败时计数并告警（内存中的记录照常更新）"""
+        try:
+            self._save(records)
+        except Exception as e:
+            self.save_failures += 1
+            self.last_save_error = str(e)
+            print(f"警告: 保存 {len(records)} 只股票的总股本失败（累计 {self.save_failures} 次）: {e}")
+
+    def _save(self, records):
+        """把股本记录批量写入 stock_shares（多行upsert）"""
+        items = list(records.items())
+        for i in range(0, len(items), SHARE_UPSERT_BATCH):
+            batch = items[i:i + SHARE_UPSERT_BATCH]
+            db.query_db(
+                'INSERT INTO stock_shares (stock_code, total_shares, effective_date, source) VALUES '
+                + ', '.join(['(%s, %s, %s, %s)'] * len(batch))
+                + ' ON DUPLICATE KEY UPDATE'
+                  ' total_shares = VALUES(total_shares),'
+                  ' effective_date = VALUES(effective_date),'
+                  ' source = VALUES(source),'
+                  ' updated_at = CURRENT_TIMESTAMP',
+                [value for code, record in batch
+                 for value in (code, record['total_shares'], record['effective_date'], record['source'])]
+            )
+
+    def refresh_from_snapshot(self):
+        """用行情快照批量刷新全部股票的总股本"""
+        self._ensure_loaded()
+        quotes, _ = self.snapshot.get_all()
+        today = datetime.date.today()
+        now = datetime.datetime.now()
+
+        records = {}
+        for code, quote in quotes.items():
+            total_shares = shares_from_quote(quote)
+            if total_shares > 0:
+                records[code] = {
+                    'total_shares': int(round(total_shares)),
+                    'effective_date': today,
+                    'source': 'market_snapshot',
+                    'updated_at': now,
+                }
+        if not records:
+            print("行情快照不可用，跳过总股本刷新")
+            return
+
+        self._persist(records)
+        with self._lock:
+            self._shares.update(records)
+        print(f"已批量刷新 {len(records)} 只股票的总股本")
+
+    def start(self, app):
+        """启动后台刷新线程，线程中通过 app 的应用上下文访问数据库"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, args=(app,), name='share-store', daemon=True)
+                self._thread.start()
+
+    def _run(self, app):
+        with app.app_context():
+            self._ensure_loaded()
+
+        # 数据库中的股本还在有效期内时，等到期后再刷新
+        newest = max((record['updated_at'] for record in self._shares.values() if record['updated_at']),
+                     default=None)
+        if newest is not None:
+            time.sleep(max(0, self.interval - (datetime.datetime.now() - newest).total_seconds()))
+
+        while True:
+            try:
+                with app.app_context():
+                    self.refresh_from_snapshot()
+            except Exception as e:
+                print(f"后台刷新总股本失败: {e}")
+            time.sleep(self.interval)
+
+    def get(self, stock_code):
+        """查询内存中的股本记录，没有时返回None"""
+        self._ensure_loaded()
+        return self._shares.get(stock_code)
+
+    def put(self, stock_code, total_shares, source):
+        """写入单只股票的股本（内存和数据库），返回记录"""
+        self._ensure_loaded()
+        record = {
+            'total_shares': int(round(total_shares)),
+            'effective_date': datetime.date.today(),
+            'source': source,
+            'updated_at': datetime.datetime.now(),
+        }
+        self._persist({stock_code: record})
+        with self._lock:
+            self._shares[stock_code] = record
+        return record
+
+    def stats(self):
+        return {
+            'shares': len(self._shares) if self._shares is not None else None,
+            'load_error': self.load_error,
+            'save_failures': self.save_failures,
+            'last_save_error': self.last_save_error,
+        }
+
+
+# 进程内共享的总股本存储
+share_store = ShareStore(quote_snapshot)
+
+
+class StockDirectory:
+    """
+    A股代码/名称目录
+    ak.stock_info_a_code_name() 只在首次使用和TTL到期时调用，
+    内存中维护：代码精确索引、代码前缀索引、名称子串索引，
+    查询时只做字典查找，不访问网络
+    """
+
+    def __init__(self, ttl=DIRECTORY_TTL):
+        self.ttl = ttl
+        # (代码->名称, 代码前缀->代码列表, 名称子串->代码列表, 加载时间)
+        self._index = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    @staticmethod
+    def _build(records):
+        by_code = {}
+        code_prefixes = {}
+        substrings = {}
+        for code, name in records:
+            by_code[code] = name
+            for i in range(1, len(code) + 1):
+                code_prefixes.setdefault(code[:i], []).append(code)
+
+            key = name.upper()
+            seen = set()
+            for i in range(len(key)):
+                for j in range(i + 1, len(key) + 1):
+                    sub = key[i:j]
+                    if sub not in seen:
+                        seen.add(sub)
+                        substrings.setdefault(sub, []).append((i, code))
+
+        # 名称前缀匹配排在前面，其余保持目录原有顺序（sort是稳定排序）
+        name_index = {}
+        for sub, hits in substrings.items():
+            hits.sort(key=lambda hit: hit[0])
+            name_index[sub] = [code for _, code in hits]
+        return by_code, code_prefixes, name_index
+
+    def refresh(self):
+        """重新下载股票目录并重建索引"""
+        stock_list = upstream.call('stock_info_a_code_name', stale_ok=False)
+        if stock_list is None or stock_list.empty:
+            raise ValueError('股票目录API返回空')
+
+        records = [(str(code).zfill(6), str(name).strip())
+                   for code, name in zip(stock_list['code'], stock_list['name'])]
+        by_code, code_prefixes, name_index = self._build(records)
+        self._index = (by_code, code_prefixes, name_index, time.time())
+        print(f"股票目录已加载，共 {len(by_code)} 只股票")
+
+    def _background_refresh(self):
+        try:
+            with self._lock:
+                self.refresh()
+        except Exception as e:
+            print(f"后台刷新股票目录失败: {e}")
+        finally:
+            self._refreshing = False
+
+    def _ensure_loaded(self):
+        index = self._index
+        if index is None:
+            # 首次使用：同步加载
+            with self._lock:
+                if self._index is None:
+                    self.refresh()
+            return self._index
+
+        if time.time() - index[3] > self.ttl and not self._refreshing:
+            # TTL到期：后台刷新，当前请求继续使用旧索引
+            self._refreshing = True
+            threading.Thread(target=self._background_refresh, name='stock-directory', daemon=True).start()
+        return index
+
+    def listing(self):
+        """返回目录中的全部股票 [(代码, 名称), ...]"""
+        by_code = self._ensure_loaded()[0]
+        return list(by_code.items())
+
+    def lookup(self, stock_input):
+        """按代码精确匹配或按名称模糊匹配，返回 {'code', 'name'}，未找到返回None"""
+        by_code, _, name_index, _ = self._ensure_loaded()
+        if stock_input.isdigit():
+            stock_code = stock_input.zfill(6)  # 补齐到6位
+            if stock_code in by_code:
+                return {'code': stock_code, 'name': by_code[stock_code]}
+            return None
+
+        codes = name_index.get(stock_input.upper())
+        if codes:
+            return {'code': codes[0], 'name': by_code[codes[0]]}
+        return None
+
+    def suggest(self, query, limit=10):
+        """自动补全：数字按代码前缀匹配，其余按名称子串匹配，返回前limit条"""
+        by_code, code_prefixes, name_index, _ = self._ensure_loaded()
+        if query.isdigit():
+            codes = code_prefixes.get(query, [])
+        else:
+            codes = name_index.get(query.upper(), [])
+        return [{'code': code, 'name': by_code[code]} for code in codes[:limit]]
+
+
+# 进程内共享的股票目录
+stock_directory = StockDirectory()
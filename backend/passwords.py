@@ -0,0 +1,154 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import check_password_hash, generate_password_hash
+
+'''
+密码哈希
+哈希和校验故意设计得很耗CPU，放在请求线程里计算会让同一进程的其他请求一起变慢，
+因此放到独立的进程池中计算；排队的任务过多时直接拒绝（接口返回503），而不是无限堆积
+'''
+
+# 哈希算法及参数（werkzeug 格式），修改后旧哈希会在用户下次登录成功时自动升级
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+PASSWORD_SALT_LENGTH = int(os.getenv('PASSWORD_SALT_LENGTH', 16))
+# 哈希进程数，为0时在请求线程中直接计算
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', min(4, os.cpu_count() or 1)))
+# 排队（含计算中）的哈希任务数上限
+PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', 64))
+# 等待单个哈希结果的最长时间（秒）
+PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', 30))
+# 哈希进程的启动方式：服务进程中有多个后台线程，fork 可能复制到被其他线程持有的锁，
+# 因此默认使用 forkserver（不支持时用 spawn）
+PASSWORD_HASH_START_METHOD = os.getenv(
+    'PASSWORD_HASH_START_METHOD',
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+
+class HasherBusyError(Exception):
+    """哈希暂时无法完成：排队的任务已达上限、等待超时或工作进程异常退出"""
+
+
+def _hash(password, method, salt_length):
+    return generate_password_hash(password, method=method, salt_length=salt_length)
+
+
+class PasswordHasher:
+    """在有界进程池中计算和校验密码哈希"""
+
+    def __init__(self, workers=PASSWORD_HASH_WORKERS, max_pending=PASSWORD_HASH_MAX_PENDING,
+                 timeout=PASSWORD_HASH_TIMEOUT, method=PASSWORD_HASH_METHOD, salt_length=PASSWORD_SALT_LENGTH,
+                 start_method=PASSWORD_HASH_START_METHOD):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.method = method
+        self.salt_length = salt_length
+        self.start_method = start_method
+        self._method_prefix = None  # werkzeug 规范化后的算法及参数，如 pbkdf2:sha256:600000
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.broken = 0
+
+    def _get_executor(self):
+        # 进程池在首次使用时创建；fork 出的子进程不能使用父进程的进程池
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context(self.start_method))
+            self._pid = os.getpid()
+        return self._executor
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+            self.completed += 1
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise HasherBusyError(f'密码哈希任务已达上限 {self.max_pending}')
+            self._pending += 1
+            try:
+                executor = self._get_executor()
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                # 工作进程异常退出后进程池不可用，重建后重试一次
+                self._executor = None
+                try:
+                    executor = self._get_executor()
+                    future = executor.submit(fn, *args)
+                except Exception:
+                    self._pending -= 1
+                    raise
+            except Exception:
+                self._pending -= 1
+                raise
+
+        # 超时或客户端断开时任务仍会完成，完成后才释放名额
+        future.add_done_callback(self._done)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise HasherBusyError(f'密码哈希等待超过 {self.timeout} 秒')
+        except BrokenProcessPool:
+            # 计算中工作进程异常退出，丢弃进程池，下次使用时重建
+            with self._lock:
+                self.broken += 1
+                if self._executor is executor:
+                    self._executor = None
+            raise HasherBusyError('密码哈希进程异常退出')
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method, self.salt_length)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def _configured_prefix(self):
+        """
+        当前配置对应的 werkzeug 算法串：werkzeug 会补全省略的参数（如 pbkdf2:sha256 存为
+        pbkdf2:sha256:600000，默认值随版本变化），因此按配置生成一次哈希取其前缀，而不是直接比较配置
+        """
+        if self._method_prefix is None:
+            self._method_prefix = self.hash('').split('$', 1)[0]
+        return self._method_prefix
+
+    def needs_rehash(self, pwhash):
+        """哈希使用的算法、参数或盐长度与当前配置不同时返回True"""
+        parts = pwhash.split('$')
+        if len(parts) != 3:
+            return True
+        method, salt, _ = parts
+        return method != self._configured_prefix() or len(salt) != self.salt_length
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'pending': self._pending,
+                'max_pending': self.max_pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'broken': self.broken,
+                'method': self.method,
+                'start_method': self.start_method,
+            }
+
+
+# 进程内共享的密码哈希器
+hasher = PasswordHasher()
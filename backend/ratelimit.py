@@ -0,0 +1,249 @@
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import g, request, jsonify, make_response
+
+'''
+令牌桶限流
+每个限流规则对每个用户（JWT中的用户ID）和每个客户端IP各维护一个令牌桶：
+桶容量为允许的突发请求数，令牌按固定速率补充，每个请求消耗一个令牌，桶空时返回429
+一个请求涉及的所有桶原子地一起检查：任一桶不足时都不扣减，被拒绝的请求不消耗其他桶的额度
+响应带 RateLimit-Limit / RateLimit-Remaining / RateLimit-Reset / RateLimit-Policy，
+被拒绝时带 Retry-After
+'''
+
+# 是否启用限流
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', '1') == '1'
+# 共享后端（Redis协议，需要安装 redis 包）的地址，未设置时使用进程内后端
+RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL')
+# 同一IP的额度为单个用户额度的倍数（一个IP后面可能有多个用户）
+RATE_LIMIT_IP_FACTOR = float(os.getenv('RATE_LIMIT_IP_FACTOR', 4))
+# 进程内后端最多保存的令牌桶数，超过后淘汰最久未使用的
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000))
+
+
+def parse_limit(limit):
+    """解析 '次数/秒数' 形式的限额，如 '30/60' 表示每60秒30次（允许一次性突发30次）"""
+    count, period = limit.split('/')
+    count, period = int(count), float(period)
+    if count <= 0 or period <= 0:
+        raise ValueError(f'无效的限额: {limit}')
+    return count, period
+
+
+class MemoryBackend:
+    """进程内的令牌桶存储，每个进程单独计数"""
+
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (令牌数, 更新时间)
+        self._lock = threading.Lock()
+
+    def take(self, buckets, cost=1):
+        """
+        buckets 为 [(key, 每秒补充的令牌数, 容量), ...]
+        所有桶都有至少 cost 个令牌时各扣减 cost 个，否则都不扣减
+        返回 (是否允许, [各桶剩余令牌数])
+        """
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            for key, rate, capacity in buckets:
+                tokens, updated_at = self._buckets.get(key, (capacity, now))
+                levels.append(min(capacity, tokens + (now - updated_at) * rate))
+            allowed = all(tokens >= cost for tokens in levels)
+            if allowed:
+                levels = [tokens - cost for tokens in levels]
+            for (key, _, _), tokens in zip(buckets, levels):
+                self._buckets[key] = (tokens, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, levels
+
+
+# 在Redis中原子地完成多个令牌桶的补充和扣减，时间取Redis服务器时间，避免各进程时钟不一致
+# KEYS 为各桶的键；ARGV[1] 为 cost，之后每个桶依次为 rate、capacity
+_TAKE_SCRIPT = '''
+local cost = tonumber(ARGV[1])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local levels = {}
+local allowed = 1
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local capacity = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    if tokens < cost then
+        allowed = 0
+    end
+    levels[i] = tokens
+end
+local result = {allowed}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local capacity = tonumber(ARGV[i * 2 + 1])
+    if allowed == 1 then
+        levels[i] = levels[i] - cost
+    end
+    redis.call('HSET', key, 'tokens', tostring(levels[i]), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(capacity / rate * 1000) + 1000)
+    result[i + 1] = tostring(levels[i])
+end
+return result
+'''
+
+
+class RedisBackend:
+    """
+    共享的令牌桶存储，多个进程/机器共用同一份计数
+    client 为 redis-py 兼容的客户端（需支持 register_script），测试时可以使用兼容的本地替身
+    """
+
+    def __init__(self, client, prefix='ratelimit:'):
+        self.prefix = prefix
+        self._take = client.register_script(_TAKE_SCRIPT)
+
+    def take(self, buckets, cost=1):
+        args = [cost]
+        for _, rate, capacity in buckets:
+            args.extend((rate, capacity))
+        allowed, *levels = self._take(keys=[self.prefix + key for key, _, _ in buckets], args=args)
+        return bool(allowed), [float(tokens) for tokens in levels]
+
+
+def create_backend():
+    """
+    根据配置创建后端：设置了 RATE_LIMIT_REDIS_URL 时使用Redis，否则使用进程内后端
+    设置了地址但没有安装 redis 包时抛出 RuntimeError（在启动时暴露配置错误，而不是每个请求都放行）
+    """
+    if RATE_LIMIT_REDIS_URL:
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError('设置了 RATE_LIMIT_REDIS_URL，但没有安装 redis 包') from e
+        return RedisBackend(redis.Redis.from_url(RATE_LIMIT_REDIS_URL))
+    return MemoryBackend()
+
+
+class RateLimiter:
+    """按规则对用户和IP限流；后端出错时放行请求，不因限流故障影响业务"""
+
+    def __init__(self, backend=None, enabled=RATE_LIMIT_ENABLED, ip_factor=RATE_LIMIT_IP_FACTOR):
+        self._backend = backend
+        self.enabled = enabled
+        self.ip_factor = ip_factor
+        self.allowed = 0
+        self.limited = 0
+        self.errors = 0
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = create_backend()
+        return self._backend
+
+    @backend.setter
+    def backend(self, backend):
+        self._backend = backend
+
+    def init_app(self, app):
+        """启动时创建后端，配置错误（如缺少 redis 包）直接导致启动失败"""
+        if self.enabled:
+            self.backend
+
+    def check(self, name, count, period, cost=1):
+        """
+        对当前请求检查规则 name，返回限流状态：
+        {'allowed', 'limit', 'remaining', 'reset', 'retry_after', 'policy'}
+        用户和IP的桶一起检查，状态取拒绝请求的桶，都允许时取剩余次数最少的桶
+        """
+        checks = [(f'ip:{request.remote_addr}:{name}', max(1, int(count * self.ip_factor)))]
+        user = g.get('user')
+        if user is not None:
+            checks.insert(0, (f'user:{user["id"]}:{name}', count))
+
+        allowed, levels = self.backend.take([(key, limit / period, limit) for key, limit in checks], cost)
+
+        result = None
+        for (key, limit), tokens in zip(checks, levels):
+            rate = limit / period
+            rejected = not allowed and tokens < cost
+            state = {
+                'allowed': allowed,
+                'limit': limit,
+                'remaining': int(tokens),
+                'reset': (limit - tokens) / rate,
+                'retry_after': (cost - tokens) / rate if rejected else 0,
+                'policy': f'{limit};w={period:g}',
+            }
+            if rejected:
+                if result is None or result['retry_after'] < state['retry_after']:
+                    result = state
+            elif allowed and (result is None or state['remaining'] < result['remaining']):
+                result = state
+        return result
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'backend': type(self._backend).__name__ if self._backend is not None else None,
+            'allowed': self.allowed,
+            'limited': self.limited,
+            'errors': self.errors,
+        }
+
+
+def _set_headers(response, state):
+    response.headers['RateLimit-Limit'] = str(state['limit'])
+    response.headers['RateLimit-Remaining'] = str(state['remaining'])
+    response.headers['RateLimit-Reset'] = str(math.ceil(state['reset']))
+    response.headers['RateLimit-Policy'] = state['policy']
+
+
+# 进程内共享的限流器
+limiter = RateLimiter()
+
+
+def rate_limit(name, limit):
+    """
+    限流装饰器，limit 为 '次数/秒数'；放在 token_required 之后，才能按用户限流
+    同名规则共用令牌桶，可以让多个接口共享同一个额度
+    """
+    count, period = parse_limit(limit)
+
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if not limiter.enabled:
+                return f(*args, **kwargs)
+
+            try:
+                state = limiter.check(name, count, period)
+            except Exception as e:
+                limiter.errors += 1
+                print(f"限流检查失败，放行请求: {e}")
+                return f(*args, **kwargs)
+
+            if not state['allowed']:
+                limiter.limited += 1
+                response = jsonify({'error': '请求过于频繁，请稍后再试'})
+                response.status_code = 429
+                response.headers['Retry-After'] = str(max(1, math.ceil(state['retry_after'])))
+                _set_headers(response, state)
+                return response
+
+            limiter.allowed += 1
+            response = make_response(f(*args, **kwargs))
+            _set_headers(response, state)
+            return response
+
+        return decorated
+
+    return decorator
@@ -0,0 +1,241 @@
+import os
+import math
+import time
+import hashlib
+import datetime
+import threading
+
+from . import db
+
+'''
+token吊销列表
+注销（或吊销）的token按 jti 记录在 revoked_token 表中，并在内存中维护：
+- 布隆过滤器：绝大多数正常token在这里就能判定为未吊销
+- 精确集合（jti -> 过期时间）：布隆过滤器命中时再精确确认，排除误判
+后台线程定期从数据库增量同步其他进程吊销的token，并清理已过期的记录
+（过期的token本身就会被拒绝，不必再记录）
+增量同步按 revoked_at 回看一段重叠窗口，晚提交的事务也能同步到；另外定期整体重新加载兜底
+吊销列表无法从数据库加载时（如旧库没有 revoked_token 表）按退避间隔重试，
+期间默认放行（签名和过期时间仍照常校验，本进程注销的token仍会被拒绝），
+设置 REVOCATION_FAIL_CLOSED=1 时改为拒绝（接口返回503）
+'''
+
+# 从数据库增量同步吊销记录的间隔（秒），也是其他进程吊销的token最长的生效延迟
+REVOCATION_SYNC_INTERVAL = float(os.getenv('REVOCATION_SYNC_INTERVAL', 5))
+# 增量同步时按 revoked_at 回看的重叠窗口（秒），覆盖插入后较晚才提交的事务
+REVOCATION_SYNC_OVERLAP = float(os.getenv('REVOCATION_SYNC_OVERLAP', 60))
+# 整体重新加载吊销记录的间隔（秒）
+REVOCATION_FULL_SYNC_INTERVAL = float(os.getenv('REVOCATION_FULL_SYNC_INTERVAL', 300))
+# 加载失败后重试的初始间隔和最大间隔（秒），每次失败间隔加倍
+REVOCATION_RETRY_MIN = float(os.getenv('REVOCATION_RETRY_MIN', 1))
+REVOCATION_RETRY_MAX = float(os.getenv('REVOCATION_RETRY_MAX', 60))
+# 吊销列表不可用时是否拒绝所有token
+REVOCATION_FAIL_CLOSED = os.getenv('REVOCATION_FAIL_CLOSED', '0') == '1'
+# 清理过期记录的间隔（秒）
+REVOCATION_PRUNE_INTERVAL = float(os.getenv('REVOCATION_PRUNE_INTERVAL', 600))
+# 布隆过滤器的初始容量与误判率，记录数超过容量后按两倍容量重建
+REVOCATION_BLOOM_CAPACITY = int(os.getenv('REVOCATION_BLOOM_CAPACITY', 100000))
+REVOCATION_BLOOM_ERROR_RATE = float(os.getenv('REVOCATION_BLOOM_ERROR_RATE', 0.001))
+
+
+class RevocationUnavailableError(Exception):
+    """吊销列表尚未加载成功，且配置为不可用时拒绝token"""
+
+
+class BloomFilter:
+    """按容量和误判率确定位数组大小和哈希函数个数的布隆过滤器（不支持删除）"""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # 双重哈希：用一次 blake2b 得到两个64位哈希，组合出 hash_count 个位置
+        digest = hashlib.blake2b(item.encode('utf8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationStore:
+    """token吊销列表，is_revoked 只访问内存"""
+
+    def __init__(self, sync_interval=REVOCATION_SYNC_INTERVAL, prune_interval=REVOCATION_PRUNE_INTERVAL,
+                 capacity=REVOCATION_BLOOM_CAPACITY, error_rate=REVOCATION_BLOOM_ERROR_RATE,
+                 sync_overlap=REVOCATION_SYNC_OVERLAP, full_sync_interval=REVOCATION_FULL_SYNC_INTERVAL,
+                 fail_closed=REVOCATION_FAIL_CLOSED):
+        self.sync_interval = sync_interval
+        self.prune_interval = prune_interval
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_overlap = datetime.timedelta(seconds=sync_overlap)
+        self.full_sync_interval = full_sync_interval
+        self.fail_closed = fail_closed
+        self._revoked = {}  # jti -> 过期时间（时间戳）
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._loaded = False  # 是否已从数据库整体加载过
+        self._synced_at = None  # 已同步记录中最大的 revoked_at
+        self._last_full_sync = None
+        self._retry_at = 0.0
+        self._retry_delay = REVOCATION_RETRY_MIN
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._thread = None
+        self.bloom_hits = 0
+        self.false_positives = 0
+        self.load_failures = 0
+
+    def _rebuild_bloom(self):
+        """按当前记录重建布隆过滤器（调用方已持有锁）"""
+        capacity = self.capacity
+        while capacity < len(self._revoked):
+            capacity *= 2
+        bloom = BloomFilter(capacity, self.error_rate)
+        for jti in self._revoked:
+            bloom.add(jti)
+        self._bloom = bloom
+
+    def _add(self, jti, expires_at):
+        """加入内存记录（调用方已持有锁）"""
+        self._revoked[jti] = expires_at
+        self._bloom.add(jti)
+        if len(self._revoked) > self._bloom.capacity:
+            self._rebuild_bloom()
+
+    def _sync(self, full=False):
+        """
+        从数据库同步吊销记录：full 为True时读取全部未过期记录，
+        否则读取 revoked_at 不早于上次同步位置减去重叠窗口的记录（重复读到的记录不影响结果）
+        """
+        # expires_at 以Unix时间戳读写（UNIX_TIMESTAMP/FROM_UNIXTIME），与 NOW() 使用同一个会话时区，
+        # 应用主机和数据库的时区不同时也不会提前或推迟过期
+        columns = 'jti, UNIX_TIMESTAMP(expires_at) AS expires_at, revoked_at'
+        if full or self._synced_at is None:
+            rows = db.query_db(f'SELECT {columns} FROM revoked_token WHERE expires_at > NOW()')
+        else:
+            rows = db.query_db(
+                f'SELECT {columns} FROM revoked_token WHERE revoked_at >= %s AND expires_at > NOW()',
+                (self._synced_at - self.sync_overlap,)
+            )
+        with self._lock:
+            for row in rows:
+                self._add(row['jti'], float(row['expires_at']))
+                if self._synced_at is None or row['revoked_at'] > self._synced_at:
+                    self._synced_at = row['revoked_at']
+            if full or not self._loaded:
+                self._loaded = True
+                self._last_full_sync = time.monotonic()
+
+    def _ensure_loaded(self):
+        """
+        首次使用时从数据库整体加载；失败后按退避间隔重试，不在每个请求中重复查询
+        其他线程正在加载时不等待，直接使用内存中已有的记录
+        """
+        if self._loaded or time.monotonic() < self._retry_at:
+            return
+        if not self._load_lock.acquire(blocking=False):
+            return
+        try:
+            if not self._loaded:
+                self._sync(full=True)
+                self._retry_delay = REVOCATION_RETRY_MIN
+        except Exception as e:
+            self.load_failures += 1
+            self._retry_at = time.monotonic() + self._retry_delay
+            print(f"加载token吊销列表失败，{self._retry_delay:g} 秒后重试: {e}")
+            self._retry_delay = min(self._retry_delay * 2, REVOCATION_RETRY_MAX)
+        finally:
+            self._load_lock.release()
+
+    def prune(self):
+        """删除已过期的吊销记录（内存和数据库）"""
+        now = time.time()
+        with self._lock:
+            expired = [jti for jti, expires_at in self._revoked.items() if expires_at <= now]
+            for jti in expired:
+                del self._revoked[jti]
+            if expired:
+                self._rebuild_bloom()
+        db.query_db('DELETE FROM revoked_token WHERE expires_at <= NOW()')
+        if expired:
+            print(f"已清理 {len(expired)} 条过期的token吊销记录")
+
+    def start(self, app):
+        """启动后台同步线程，线程中通过 app 的应用上下文访问数据库"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, args=(app,), name='token-revocation',
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self, app):
+        last_prune = time.monotonic()
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                with app.app_context():
+                    if not self._loaded:
+                        self._ensure_loaded()
+                        continue
+                    self._sync(full=time.monotonic() - self._last_full_sync >= self.full_sync_interval)
+                    if time.monotonic() - last_prune >= self.prune_interval:
+                        self.prune()
+                        last_prune = time.monotonic()
+            except Exception as e:
+                print(f"同步token吊销记录失败: {e}")
+
+    def revoke(self, jti, expires_at, user_id=None):
+        """吊销一个token，expires_at 为token的过期时间戳"""
+        db.query_db(
+            'INSERT IGNORE INTO revoked_token (jti, user_id, expires_at) VALUES (%s, %s, FROM_UNIXTIME(%s))',
+            (jti, user_id, expires_at)
+        )
+        with self._lock:
+            self._add(jti, expires_at)
+
+    def is_revoked(self, jti):
+        """
+        判断token是否已被吊销；首次调用时同步加载数据库中的记录
+        吊销列表尚未加载成功时按 fail_closed 处理：抛出 RevocationUnavailableError，或只按内存中的记录判断
+        """
+        if not jti:
+            return False
+        self._ensure_loaded()
+        if not self._loaded and self.fail_closed:
+            raise RevocationUnavailableError('token吊销列表暂不可用')
+        if jti not in self._bloom:
+            return False
+        self.bloom_hits += 1
+        revoked = jti in self._revoked
+        if not revoked:
+            self.false_positives += 1
+        return revoked
+
+    def stats(self):
+        with self._lock:
+            return {
+                'revoked': len(self._revoked),
+                'loaded': self._loaded,
+                'load_failures': self.load_failures,
+                'fail_closed': self.fail_closed,
+                'bloom_size_bits': self._bloom.size,
+                'bloom_hash_count': self._bloom.hash_count,
+                'bloom_hits': self.bloom_hits,
+                'false_positives': self.false_positives,
+                'synced_at': self._synced_at.isoformat() if self._synced_at is not None else None,
+            }
+
+
+# 进程内共享的token吊销列表
+revocation_store = RevocationStore()
@@ -1,3 +1,4 @@
+DROP TABLE IF EXISTS revoked_token;
 DROP TABLE IF EXISTS post;
 DROP TABLE IF EXISTS user;
 
@@ -13,5 +14,19 @@ CREATE TABLE post (
     body TEXT NOT NULL,
     created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     author_id INT NOT NULL,
-    FOREIGN KEY (author_id) REFERENCES user (id) ON DELETE CASCADE
+    FOREIGN KEY (author_id) REFERENCES user (id) ON DELETE CASCADE,
+    -- 帖子列表按 (created, id) 倒序游标分页
+    INDEX idx_post_created_id (created, id),
+    -- 帖子全文搜索，ngram分词以支持中文
+    FULLTEXT INDEX ft_post_title_body (title, body) WITH PARSER ngram
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- 已吊销（注销）的token，过期后会被自动清理
+CREATE TABLE revoked_token (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    jti CHAR(32) NOT NULL UNIQUE,
+    user_id INT,
+    expires_at DATETIME NOT NULL,
+    revoked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_revoked_token_expires_at (expires_at)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
\ No newline at end of file
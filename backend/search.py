@@ -0,0 +1,249 @@
+import os
+import math
+import re
+import heapq
+import threading
+import time
+
+import MySQLdb
+
+from . import db
+
+'''
+论坛帖子全文搜索
+优先使用 post 表上的 FULLTEXT 索引（ngram 分词，支持中文）；
+数据库不支持或没有全文索引时（如测试环境），退回到进程内的倒排索引
+'''
+
+# 搜索后端：auto（优先MySQL，失败时退回内存索引）、mysql、memory
+BLOG_SEARCH_BACKEND = os.getenv('BLOG_SEARCH_BACKEND', 'auto')
+# 内存倒排索引从数据库整体重建的周期（秒），用于同步其他进程写入的帖子
+BLOG_SEARCH_INDEX_TTL = float(os.getenv('BLOG_SEARCH_INDEX_TTL', 300))
+# 标题中的词在相关度计算中的权重（按出现次数的倍数计）
+TITLE_WEIGHT = 2
+# 与 MySQL 的 ngram_token_size 默认值一致
+NGRAM_SIZE = 2
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 表示全文搜索不可用的MySQL错误码，只有这些错误才退回内存索引：
+# 1191 没有与列匹配的FULLTEXT索引（如ngram分词器不可用、索引未创建），1214 存储引擎不支持FULLTEXT
+FULLTEXT_UNAVAILABLE_ERRORS = (1191, 1214)
+
+_WORD_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """
+    按 ngram 分词：每个连续的字母/数字/汉字串切成长度为 NGRAM_SIZE 的片段，
+    短于 NGRAM_SIZE 的串整体作为一个词，与 MySQL ngram 分词器的结果基本一致
+    """
+    tokens = []
+    for word in _WORD_RE.findall((text or '').lower()):
+        if len(word) <= NGRAM_SIZE:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + NGRAM_SIZE] for i in range(len(word) - NGRAM_SIZE + 1))
+    return tokens
+
+
+class InvertedIndex:
+    """
+    进程内的帖子倒排索引
+    词 -> {帖子ID: 加权词频}，与 MySQL 的 NATURAL LANGUAGE MODE 一致，
+    包含任一查询词的帖子都会返回，按BM25排序（包含的查询词越多、越少见，得分越高）
+    """
+
+    def __init__(self, ttl=BLOG_SEARCH_INDEX_TTL):
+        self.ttl = ttl
+        self._postings = {}
+        self._doc_terms = {}  # 帖子ID -> 包含的词，删除时只需访问这些倒排表
+        self._doc_lengths = {}
+        self._total_length = 0
+        self._built_at = None
+        self._lock = threading.RLock()
+        self._rebuilding = False
+        # 重建期间发生的修改 [(帖子ID, 标题, 正文) 或 (帖子ID, None, None) 表示删除]，换入新索引后重放
+        self._changes = None
+
+    def _add(self, post_id, title, body):
+        counts = {}
+        for token in tokenize(title):
+            counts[token] = counts.get(token, 0) + TITLE_WEIGHT
+        for token in tokenize(body):
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            self._postings.setdefault(token, {})[post_id] = count
+        self._doc_terms[post_id] = tuple(counts)
+        length = sum(counts.values())
+        self._doc_lengths[post_id] = length
+        self._total_length += length
+
+    def _remove(self, post_id):
+        length = self._doc_lengths.pop(post_id, None)
+        if length is None:
+            return
+        self._total_length -= length
+        for token in self._doc_terms.pop(post_id, ()):
+            postings = self._postings.get(token)
+            if postings is not None:
+                postings.pop(post_id, None)
+                if not postings:
+                    del self._postings[token]
+
+    def rebuild(self):
+        """
+        从 post 表流式读取全部帖子，重建索引后整体替换
+        读取期间本进程的修改会记录下来，在换入新索引后重放，不会因为读到的是旧数据而丢失
+        """
+        with self._lock:
+            self._changes = []
+        try:
+            fresh = InvertedIndex(self.ttl)
+            for rows in db.iter_query('SELECT id, title, body FROM post', chunk_size=1000):
+                for row in rows:
+                    fresh._add(row['id'], row['title'], row['body'])
+            with self._lock:
+                for post_id, title, body in self._changes:
+                    fresh._remove(post_id)
+                    if title is not None:
+                        fresh._add(post_id, title, body)
+                self._postings = fresh._postings
+                self._doc_terms = fresh._doc_terms
+                self._doc_lengths = fresh._doc_lengths
+                self._total_length = fresh._total_length
+                self._built_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._changes = None
+        print(f"帖子搜索索引已重建，共 {len(self._doc_lengths)} 篇帖子")
+
+    def _rebuild_in_background(self):
+        try:
+            self.rebuild()
+        except Exception as e:
+            print(f"重建帖子搜索索引失败: {e}")
+        finally:
+            self._rebuilding = False
+
+    @property
+    def is_built(self):
+        """索引是否已建立或正在建立（都不是时不必同步帖子的修改）"""
+        return self._built_at is not None or self._changes is not None
+
+    def _ensure_built(self):
+        """首次使用时同步建立索引，过期后在后台重建（重建期间继续使用旧索引）"""
+        if self._built_at is None:
+            with self._lock:
+                if self._built_at is None:
+                    self.rebuild()
+            return
+        if time.monotonic() - self._built_at > self.ttl and not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild_in_background, name='post-search-index', daemon=True).start()
+
+    def upsert(self, post_id, title, body):
+        """本进程新建或修改帖子后更新索引（索引尚未建立时不必处理）"""
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((post_id, title, body))
+            if self._built_at is not None:
+                self._remove(post_id)
+                self._add(post_id, title, body)
+
+    def remove(self, post_id):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((post_id, None, None))
+            if self._built_at is not None:
+                self._remove(post_id)
+
+    def search(self, query, limit, offset=0):
+        """返回按相关度倒序的 [(帖子ID, 得分), ...]"""
+        self._ensure_built()
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        with self._lock:
+            postings = [p for p in (self._postings.get(term) for term in terms) if p]
+            if not postings:
+                return []
+            candidates = set().union(*postings)
+
+            doc_count = len(self._doc_lengths)
+            avg_length = self._total_length / doc_count if doc_count else 0
+            idfs = [math.log(1 + (doc_count - len(p) + 0.5) / (len(p) + 0.5)) for p in postings]
+
+            def score(post_id):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._doc_lengths[post_id] / avg_length)
+                return sum(idf * p[post_id] * (BM25_K1 + 1) / (p[post_id] + norm)
+                           for idf, p in zip(idfs, postings) if post_id in p)
+
+            top = heapq.nlargest(offset + limit, ((score(post_id), post_id) for post_id in candidates))
+        return [(post_id, score) for score, post_id in top[offset:]]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'posts': len(self._doc_lengths),
+                'terms': len(self._postings),
+                'age': round(time.monotonic() - self._built_at, 1) if self._built_at is not None else None,
+            }
+
+
+POST_COLUMNS = 'p.id, title, body, created, author_id, username'
+
+
+def _search_mysql(query, limit, offset):
+    return db.query_db(
+        f'SELECT {POST_COLUMNS}, MATCH(title, body) AGAINST (%s IN NATURAL LANGUAGE MODE) AS score'
+        ' FROM post p JOIN user u ON p.author_id = u.id'
+        ' WHERE MATCH(title, body) AGAINST (%s IN NATURAL LANGUAGE MODE)'
+        ' ORDER BY score DESC, p.id DESC'
+        ' LIMIT %s OFFSET %s',
+        (query, query, limit, offset)
+    )
+
+
+def _search_memory(query, limit, offset):
+    hits = post_index.search(query, limit, offset)
+    if not hits:
+        return []
+    rows = db.query_db(
+        f'SELECT {POST_COLUMNS} FROM post p JOIN user u ON p.author_id = u.id'
+        f' WHERE p.id IN ({", ".join(["%s"] * len(hits))})',
+        [post_id for post_id, _ in hits]
+    )
+    by_id = {row['id']: row for row in rows}
+    results = []
+    for post_id, score in hits:
+        row = by_id.get(post_id)
+        if row is not None:  # 索引中可能还有其他进程已删除的帖子
+            row['score'] = score
+            results.append(row)
+    return results
+
+
+# 进程内的帖子倒排索引
+post_index = InvertedIndex()
+# 当前使用的搜索后端；auto 模式下MySQL全文搜索不可用时切换为 memory
+_backend = BLOG_SEARCH_BACKEND
+
+
+def search_posts(query, limit, offset=0):
+    """
+    搜索帖子，返回按相关度倒序的帖子列表（带 score 字段）
+    MySQL全文搜索不可用（没有全文索引或不支持ngram）时自动退回内存倒排索引；
+    连接断开、锁等待超时等其他数据库错误照常抛出，不切换后端
+    """
+    global _backend
+    if _backend != 'memory':
+        try:
+            return _search_mysql(query, limit, offset)
+        except (MySQLdb.OperationalError, MySQLdb.ProgrammingError) as e:
+            if _backend == 'mysql' or not e.args or e.args[0] not in FULLTEXT_UNAVAILABLE_ERRORS:
+                raise
+            print(f"MySQL全文搜索不可用，改用内存倒排索引: {e}")
+            _backend = 'memory'
+    return _search_memory(query, limit, offset)
@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import statistics
+import subprocess
+import click
+
+'''
+启动耗时基准
+在全新的Python进程中导入本包并调用 create_app()，测量耗时，
+并检查启动过程中是否导入了只应在股票接口中按需导入的重量级依赖
+'''
+
+# 不应在 create_app() 期间导入的模块（首次调用股票接口时才导入）
+HEAVY_MODULES = ('akshare', 'pandas', 'numpy')
+# create_app() 的默认耗时预算（秒）
+STARTUP_BUDGET_SECONDS = float(os.getenv('STARTUP_BUDGET_SECONDS', 1.0))
+
+# 在子进程中执行：分别计时导入包和 create_app()，输出JSON
+_PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import {package}
+imported = time.perf_counter()
+{package}.create_app()
+created = time.perf_counter()
+print(json.dumps({{
+    'import_seconds': imported - started,
+    'create_app_seconds': created - imported,
+    'total_seconds': created - started,
+    'heavy_modules': [name for name in {heavy!r} if name in sys.modules],
+}}))
+'''
+
+
+def measure_startup(runs=5):
+    """
+    在 runs 个全新进程中测量启动耗时，返回各次结果及总耗时的中位数
+    子进程不带 -X importtime 等开关，结果与实际启动工作进程一致
+    """
+    package = __package__
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    probe = _PROBE.format(package=package, heavy=HEAVY_MODULES)
+
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', probe],
+            cwd=package_parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        # 启动过程中可能有其他输出，结果在最后一行
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    return {
+        'runs': results,
+        'median_total_seconds': statistics.median(result['total_seconds'] for result in results),
+        'heavy_modules': sorted({name for result in results for name in result['heavy_modules']}),
+    }
+
+
+@click.command('startup-benchmark')
+@click.option('--runs', default=5, show_default=True, help='测量次数（每次一个新进程）')
+@click.option('--budget', default=STARTUP_BUDGET_SECONDS, show_default=True, help='启动耗时中位数的上限（秒）')
+@click.option('--json', 'as_json', is_flag=True, help='以JSON输出结果')
+def startup_benchmark_command(runs, budget, as_json):
+    """Measure create_app() import time and fail on regressions."""
+    report = measure_startup(runs)
+    median = report['median_total_seconds']
+    failures = []
+    if report['heavy_modules']:
+        failures.append(f"启动时导入了重量级依赖: {', '.join(report['heavy_modules'])}")
+    if median > budget:
+        failures.append(f'启动耗时中位数 {median:.3f}s 超过预算 {budget:.3f}s')
+
+    if as_json:
+        click.echo(json.dumps({**report, 'budget_seconds': budget, 'failures': failures}, ensure_ascii=False))
+    else:
+        for i, result in enumerate(report['runs'], 1):
+            click.echo(f"第{i}次: 导入 {result['import_seconds']:.3f}s，"
+                       f"create_app {result['create_app_seconds']:.3f}s，合计 {result['total_seconds']:.3f}s")
+        click.echo(f'启动耗时中位数: {median:.3f}s（预算 {budget:.3f}s）')
+        for failure in failures:
+            click.echo(failure, err=True)
+
+    if failures:
+        sys.exit(1)
@@ -1,36 +1,52 @@
 import os
-import akshare as ak
-import pandas as pd
-from flask import Blueprint, request, jsonify, current_app
-from functools import wraps
-import jwt
-from . import db
+import json
+import math
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from flask import Blueprint, Response, g, request, jsonify, current_app, stream_with_context
+from . import db, financials, jobs, upstream
+from .auth import token_required
+from .ratelimit import limiter, rate_limit
+from .cache import LRUCache
+from .market import quote_snapshot, stock_directory, share_store, shares_from_quote
 
 # 创建股票估值蓝图
 stock_bp = Blueprint('stock', __name__, url_prefix='/stock')
 
-
-def token_required(f):
-    """JWT token验证装饰器"""
-
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = request.headers.get('Authorization')
-        if not token:
-            return jsonify({'error': '缺少token'}), 401
-
-        try:
-            if token.startswith('Bearer '):
-                token = token.split(' ')[1]
-            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
-        except jwt.ExpiredSignatureError:
-            return jsonify({'error': 'token已过期'}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({'error': 'token无效'}), 401
-
-        return f(*args, **kwargs)
-
-    return decorated
+# 并发获取财务报表的线程池大小与单个报表的超时时间（秒）
+STATEMENT_FETCH_WORKERS = int(os.getenv('STATEMENT_FETCH_WORKERS', 6))
+STATEMENT_FETCH_TIMEOUT = float(os.getenv('STATEMENT_FETCH_TIMEOUT', 15))
+
+# 各接口的限流额度（'次数/秒数'，按用户计，同一IP的额度为其 RATE_LIMIT_IP_FACTOR 倍）
+# 同名规则共享额度，如 /valuation、/valuation/stream、/valuation/jobs 共用 valuation 额度
+RATE_LIMIT_SEARCH = os.getenv('RATE_LIMIT_SEARCH', '120/60')
+RATE_LIMIT_SUGGEST = os.getenv('RATE_LIMIT_SUGGEST', '600/60')
+RATE_LIMIT_VALUATION = os.getenv('RATE_LIMIT_VALUATION', '30/60')
+RATE_LIMIT_VALUATION_HEAVY = os.getenv('RATE_LIMIT_VALUATION_HEAVY', '10/60')
+RATE_LIMIT_MARKET_DATA = os.getenv('RATE_LIMIT_MARKET_DATA', '60/60')
+RATE_LIMIT_EXPORT = os.getenv('RATE_LIMIT_EXPORT', '5/60')
+
+# 批量估值时需要访问网络的股票（库中没有或已过期、本地没有股本）并发获取的线程数，
+# 以及整批等待的最长时间（秒），超时的股票按获取失败返回
+BATCH_FALLBACK_WORKERS = int(os.getenv('BATCH_FALLBACK_WORKERS', 4))
+BATCH_FALLBACK_TIMEOUT = float(os.getenv('BATCH_FALLBACK_TIMEOUT', 30))
+
+# 进程内共享的有界线程池，限制同时进行的AKShare报表请求数
+statement_executor = ThreadPoolExecutor(max_workers=STATEMENT_FETCH_WORKERS,
+                                        thread_name_prefix='statement-fetch')
+# 批量估值回退获取用的有界线程池，所有批量请求共用
+batch_fallback_executor = ThreadPoolExecutor(max_workers=BATCH_FALLBACK_WORKERS,
+                                             thread_name_prefix='batch-fallback')
+
+
+@stock_bp.after_request
+def mark_stale_response(response):
+    """本次请求使用了上游的旧数据时，通过 Warning 响应头告知客户端"""
+    stale = upstream.stale_upstreams()
+    if stale:
+        response.headers['Warning'] = f'110 - "Response is Stale: {", ".join(stale)}"'
+    return response
 
 
 class DCFValuation:
@@ -55,40 +71,17 @@ class DCFValuation:
                    stage2_years=5, stage2_growth=0.05, stage3_years=0, stage3_growth=0.02):
         """
         通用DCF计算方法，支持多阶段增长
+        基于 dcf.enterprise_values 的闭式公式计算，批量计算请直接使用 dcf 模块
         """
-        try:
-            total_value = 0
-            current_fcf = fcf
-
-            # 第一阶段：高增长期
-            if stage1_years > 0:
-                for year in range(1, stage1_years + 1):
-                    current_fcf = current_fcf * (1 + stage1_growth)
-                    pv = current_fcf / ((1 + discount_rate) ** year)
-                    total_value += pv
-
-            # 第二阶段：中期增长
-            if stage2_years > 0:
-                stage2_start_year = stage1_years + 1
-                for year in range(stage2_start_year, stage2_start_year + stage2_years):
-                    current_fcf = current_fcf * (1 + stage2_growth)
-                    pv = current_fcf / ((1 + discount_rate) ** year)
-                    total_value += pv
-
-            # 第三阶段：永续增长或稳定期
-            if stage3_years == 0:  # 永续增长
-                terminal_year = stage1_years + stage2_years + 1
-                terminal_fcf = current_fcf * (1 + stage3_growth)
-                terminal_value = terminal_fcf / (discount_rate - stage3_growth)
-                terminal_pv = terminal_value / ((1 + discount_rate) ** (terminal_year - 1))
-                total_value += terminal_pv
-            else:  # 有限期增长
-                stage3_start_year = stage1_years + stage2_years + 1
-                for year in range(stage3_start_year, stage3_start_year + stage3_years):
-                    current_fcf = current_fcf * (1 + stage3_growth)
-                    pv = current_fcf / ((1 + discount_rate) ** year)
-                    total_value += pv
+        from . import dcf
 
+        try:
+            total_value = float(dcf.enterprise_values(
+                fcf, discount_rate, stage1_years, stage1_growth,
+                stage2_years, stage2_growth, stage3_years, stage3_growth
+            ))
+            if not math.isfinite(total_value):
+                raise ValueError('DCF结果不是有限值，折现率可能等于永续增长率')
             return total_value
         except Exception as e:
             print(f"DCF计算时出错: {e}")
@@ -96,31 +89,15 @@ class DCFValuation:
 
 
 def get_stock_info_from_akshare(stock_input):
-    """从AKShare获取股票信息"""
+    """从AKShare股票目录（内存索引）获取股票信息"""
     try:
-        # 获取股票列表
-        stock_list = ak.stock_info_a_code_name()
-
-        # 判断输入是股票代码还是公司名称
-        if stock_input.isdigit():
-            # 输入是股票代码
-            stock_code = stock_input.zfill(6)  # 补齐到6位
-            stock_info = stock_list[stock_list['code'] == stock_code]
-            if not stock_info.empty:
-                return {
-                    'code': stock_code,
-                    'name': stock_info.iloc[0]['name'],
-                    'success': True
-                }
-        else:
-            # 输入是公司名称
-            stock_info = stock_list[stock_list['name'].str.contains(stock_input, na=False)]
-            if not stock_info.empty:
-                return {
-                    'code': stock_info.iloc[0]['code'],
-                    'name': stock_info.iloc[0]['name'],
-                    'success': True
-                }
+        stock_info = stock_directory.lookup(stock_input)
+        if stock_info is not None:
+            return {
+                'code': stock_info['code'],
+                'name': stock_info['name'],
+                'success': True
+            }
 
         return {'success': False, 'message': '未找到匹配的股票信息'}
     except Exception as e:
@@ -174,7 +151,7 @@ def get_financial_data_from_database(stock_code):
         financial_records = db.query_db(
             '''SELECT stock_code, company_name, report_year, report_date, 
                       net_income, interest_expense, depreciation, capex, 
-                      current_assets, current_liabilities, total_shares
+                      current_assets, current_liabilities, total_shares, updated_at
                FROM financial_data 
                WHERE stock_code = %s 
                ORDER BY report_year DESC 
@@ -187,41 +164,101 @@ def get_financial_data_from_database(stock_code):
             return {'success': False, 'message': '数据库中未找到该股票的财务数据'}
 
         print(f"从数据库获取到 {len(financial_records)} 年的财务数据")
-
-        # 转换数据格式
-        financial_data = []
-        for record in financial_records:
-            year_data = {
-                'year': str(record['report_date']),
-                'net_income': float(record['net_income']) if record['net_income'] else 0,
-                'interest_expense': float(record['interest_expense']) if record['interest_expense'] else 0,
-                'depreciation': float(record['depreciation']) if record['depreciation'] else 0,
-                'capex': float(record['capex']) if record['capex'] else 0,
-                'current_assets': float(record['current_assets']) if record['current_assets'] else 0,
-                'current_liabilities': float(record['current_liabilities']) if record['current_liabilities'] else 0,
-                'total_shares': int(record['total_shares']) if record['total_shares'] else 0,
-            }
-            financial_data.append(year_data)
-            print(f"{record['report_year']}年数据: 净利润={year_data['net_income'] / 100000000:.2f}亿")
-
-        return {'success': True, 'data': financial_data}
+        return format_financial_records(financial_records)
 
     except Exception as e:
         print(f"从数据库获取财务数据失败: {e}")
         return {'success': False, 'message': f'获取财务数据失败: {str(e)}'}
 
 
-def get_financial_data_mixed(stock_code):
-    """混合获取财务数据：先从数据库获取，如果没有则生成fake数据"""
+def get_financial_data_from_database_batch(stock_codes):
+    """
+    一次 IN (...) 查询获取多只股票最近3年的财务数据
+    返回 {股票代码: 与 get_financial_data_from_database 相同格式的结果}，数据库中没有的股票不在结果中
+    """
+    placeholders = ', '.join(['%s'] * len(stock_codes))
+    financial_records = db.query_db(
+        f'''SELECT stock_code, company_name, report_year, report_date,
+                  net_income, interest_expense, depreciation, capex,
+                  current_assets, current_liabilities, total_shares, updated_at
+           FROM financial_data
+           WHERE stock_code IN ({placeholders})
+           ORDER BY stock_code, report_year DESC''',
+        tuple(stock_codes)
+    )
+
+    grouped = {}
+    for record in financial_records:
+        records = grouped.setdefault(record['stock_code'], [])
+        if len(records) < 3:
+            records.append(record)
+
+    print(f"批量从数据库获取到 {len(grouped)}/{len(stock_codes)} 只股票的财务数据")
+    return {stock_code: format_financial_records(records) for stock_code, records in grouped.items()}
+
+
+def format_financial_records(financial_records):
+    """把 financial_data 表的记录（按年份倒序）转换为估值使用的财务数据格式"""
+    financial_data = []
+    for record in financial_records:
+        year_data = {
+            'year': str(record['report_date']),
+            'net_income': float(record['net_income']) if record['net_income'] else 0,
+            'interest_expense': float(record['interest_expense']) if record['interest_expense'] else 0,
+            'depreciation': float(record['depreciation']) if record['depreciation'] else 0,
+            'capex': float(record['capex']) if record['capex'] else 0,
+            'current_assets': float(record['current_assets']) if record['current_assets'] else 0,
+            'current_liabilities': float(record['current_liabilities']) if record['current_liabilities'] else 0,
+            'total_shares': int(record['total_shares']) if record['total_shares'] else 0,
+        }
+        financial_data.append(year_data)
+        print(f"{record['stock_code']} {record['report_year']}年数据: 净利润={year_data['net_income'] / 100000000:.2f}亿")
+
+    # 最近一次同步时间，用于判断数据是否需要重新获取
+    updated_at = max((record['updated_at'] for record in financial_records if record['updated_at']),
+                     default=None)
+    return {
+        'success': True,
+        'data': financial_data,
+        'updated_at': updated_at,
+        'stale': financials.is_stale(updated_at)
+    }
+
+
+def get_financial_data_mixed(stock_code, db_result=None):
+    """
+    混合获取财务数据：
+    1. 数据库中有未过期的数据则直接使用
+    2. 否则（写回模式下）从AKShare获取并写回数据库，供后续估值直接读取
+    3. AKShare获取失败时使用数据库中的过期数据，仍没有则生成fake数据
+    db_result 为已经查询过的数据库结果（如批量查询），提供时不再重复查询
+    """
     try:
         print(f"混合方式获取股票 {stock_code} 的财务数据...")
 
         # 先尝试从数据库获取
-        db_result = get_financial_data_from_database(stock_code)
-        if db_result['success']:
+        if db_result is None:
+            db_result = get_financial_data_from_database(stock_code)
+        if db_result['success'] and not db_result['stale']:
             print(f"从数据库获取到财务数据")
             return db_result
 
+        if financials.FINANCIAL_DATA_WRITE_THROUGH:
+            print(f"数据库中没有有效的财务数据，从AKShare获取...")
+            akshare_result = get_financial_data_from_akshare(stock_code)
+            # 备用方法生成的估算数据（带note）不写回数据库
+            if akshare_result['success'] and not akshare_result.get('note'):
+                try:
+                    financials.save_financial_data(stock_code, akshare_result.get('company_name'),
+                                                   akshare_result['data'])
+                except Exception as e:
+                    print(f"写回财务数据失败: {e}")
+                return akshare_result
+
+        if db_result['success']:
+            print(f"使用数据库中已过期的财务数据")
+            return db_result
+
         # 数据库没有数据，生成fake数据
         print(f"数据库中没有财务数据，生成fake数据...")
         return generate_fake_financial_data(stock_code)
@@ -288,54 +325,87 @@ def generate_fake_financial_data(stock_code):
         return {'success': False, 'message': f'生成财务数据失败: {str(e)}'}
 
 
-def get_financial_data_from_akshare(stock_code):
-    """从AKShare获取财务数据"""
-    try:
-        print(f"正在获取股票 {stock_code} 的财务数据...")
+def _fetch_statement(label, function_name, stock_code, direct=False):
+    """在线程池中获取单个财务报表，返回 (DataFrame, 耗时秒数)；direct 为True时绕过熔断直接调用上游"""
+    import pandas as pd
 
-        # 获取现金流量表数据
+    started = time.perf_counter()
+    try:
+        if direct:
+            statement = upstream.call_direct(function_name, symbol=stock_code)
+        else:
+            statement = upstream.call(function_name, symbol=stock_code)
+        if statement is None:
+            print(f"{label}API返回None，可能是股票代码不存在或API问题")
+            statement = pd.DataFrame()
+        else:
+            print(f"{label}数据获取成功，共 {len(statement)} 条记录")
+            if not statement.empty:
+                print(f"{label}字段: {statement.columns.tolist()}")
+    except Exception as e:
+        print(f"获取{label}失败: {e}")
+        statement = pd.DataFrame()
+    return statement, time.perf_counter() - started
+
+
+def fetch_statements_concurrently(stock_code, timeout=STATEMENT_FETCH_TIMEOUT, executor=None, direct=False):
+    """
+    并发获取现金流量表、资产负债表、利润表
+    总耗时取决于最慢的报表而不是三者之和；超时的报表会被取消并按空表处理
+    executor 默认使用进程内共享的 statement_executor，批量任务可传入自己的线程池
+    direct 为True时绕过熔断和旧数据缓存（批量任务使用，不影响线上请求）
+    返回 ({报表名: DataFrame}, {报表名: 耗时秒数或None})
+    """
+    import pandas as pd
+
+    fetchers = {
+        'cash_flow': ('现金流量表', 'stock_cash_flow_sheet_by_yearly_em'),
+        'balance_sheet': ('资产负债表', 'stock_balance_sheet_by_yearly_em'),
+        'income_statement': ('利润表', 'stock_profit_sheet_by_yearly_em'),
+    }
+    executor = executor or statement_executor
+    futures = {
+        key: executor.submit(_fetch_statement, label, function_name, stock_code, direct)
+        for key, (label, function_name) in fetchers.items()
+    }
+
+    deadline = time.monotonic() + timeout
+    statements = {}
+    timings = {}
+    for key, future in futures.items():
         try:
-            cash_flow = ak.stock_cash_flow_sheet_by_yearly_em(symbol=stock_code)
-            if cash_flow is None:
-                print(f"现金流量表API返回None，可能是股票代码不存在或API问题")
-                cash_flow = pd.DataFrame()
-            else:
-                print(f"现金流量表数据获取成功，共 {len(cash_flow)} 条记录")
-                if not cash_flow.empty:
-                    print(f"现金流量表字段: {cash_flow.columns.tolist()}")
-        except Exception as e:
-            print(f"获取现金流量表失败: {e}")
-            cash_flow = pd.DataFrame()
+            statements[key], elapsed = future.result(timeout=max(0, deadline - time.monotonic()))
+            timings[key] = round(elapsed, 3)
+        except FutureTimeoutError:
+            # 还在排队的任务可以直接取消；已在执行的请求无法中断，结果将被丢弃
+            future.cancel()
+            print(f"获取{fetchers[key][0]}超时（{timeout}秒），已取消")
+            statements[key] = pd.DataFrame()
+            timings[key] = None
+
+    print(f"股票 {stock_code} 财务报表获取耗时: {timings}")
+    return statements, timings
+
+
+def get_financial_data_from_akshare(stock_code, executor=None, direct=False):
+    """
+    从AKShare获取财务数据
+    direct 为True时（批量抓取）绕过线上请求共用的熔断器和旧数据缓存，报表不全时直接返回失败，不使用估算数据
+    """
+    import pandas as pd
 
-        # 获取资产负债表数据
-        try:
-            balance_sheet = ak.stock_balance_sheet_by_yearly_em(symbol=stock_code)
-            if balance_sheet is None:
-                print(f"资产负债表API返回None，可能是股票代码不存在或API问题")
-                balance_sheet = pd.DataFrame()
-            else:
-                print(f"资产负债表数据获取成功，共 {len(balance_sheet)} 条记录")
-                if not balance_sheet.empty:
-                    print(f"资产负债表字段: {balance_sheet.columns.tolist()}")
-        except Exception as e:
-            print(f"获取资产负债表失败: {e}")
-            balance_sheet = pd.DataFrame()
+    try:
+        print(f"正在获取股票 {stock_code} 的财务数据...")
 
-        # 获取利润表数据
-        try:
-            income_statement = ak.stock_profit_sheet_by_yearly_em(symbol=stock_code)
-            if income_statement is None:
-                print(f"利润表API返回None，可能是股票代码不存在或API问题")
-                income_statement = pd.DataFrame()
-            else:
-                print(f"利润表数据获取成功，共 {len(income_statement)} 条记录")
-                if not income_statement.empty:
-                    print(f"利润表字段: {income_statement.columns.tolist()}")
-        except Exception as e:
-            print(f"获取利润表失败: {e}")
-            income_statement = pd.DataFrame()
+        # 并发获取现金流量表、资产负债表、利润表
+        statements, timings = fetch_statements_concurrently(stock_code, executor=executor, direct=direct)
+        cash_flow = statements['cash_flow']
+        balance_sheet = statements['balance_sheet']
+        income_statement = statements['income_statement']
 
         if cash_flow.empty or balance_sheet.empty or income_statement.empty:
+            if direct:
+                return {'success': False, 'message': '财务报表不完整'}
             # 尝试使用备用方法获取基础财务数据
             print("尝试使用备用方法获取财务数据...")
             return get_simplified_financial_data(stock_code)
@@ -390,7 +460,13 @@ def get_financial_data_from_akshare(stock_code):
         if not financial_data:
             return {'success': False, 'message': '无法解析财务数据，可能字段格式已变更'}
 
-        return {'success': True, 'data': financial_data}
+        # 缺失的名称在 DataFrame 中是 NaN（布尔值为真），不能直接用 not 判断
+        company_name = financials.valid_company_name(cash_flow.iloc[0].get('SECURITY_NAME_ABBR'))
+        if not company_name:
+            stock_info = stock_directory.lookup(stock_code)
+            company_name = stock_info['name'] if stock_info else stock_code
+
+        return {'success': True, 'data': financial_data, 'company_name': company_name, 'timings': timings}
     except Exception as e:
         print(f"获取财务数据总体错误: {e}")
         return {'success': False, 'message': f'获取财务数据失败: {str(e)}'}
@@ -403,18 +479,18 @@ def get_stock_shares_from_akshare(stock_code):
 
         # 尝试获取股本结构数据
         try:
-            shares_info = ak.stock_share_change_sse(symbol=stock_code)
+            shares_info = upstream.call('stock_share_change_sse', symbol=stock_code)
             if shares_info is not None and not shares_info.empty:
                 # 获取最新的总股本（单位：万股）
                 total_shares = float(shares_info.iloc[0]['总股本']) * 10000  # 转换为股
                 print(f"从股本变动数据获取总股本: {total_shares} 股")
-                return {'success': True, 'total_shares': total_shares}
+                return {'success': True, 'total_shares': total_shares, 'source': 'akshare_sse'}
         except Exception as e:
             print(f"获取股本结构数据失败: {e}")
 
         # 如果无法获取股本数据，尝试从基本信息获取
         try:
-            stock_info = ak.stock_individual_info_em(symbol=stock_code)
+            stock_info = upstream.call('stock_individual_info_em', symbol=stock_code)
             if stock_info is not None and not stock_info.empty:
                 print(f"股票基本信息可用，尝试提取总股本...")
                 shares_row = stock_info[stock_info['item'] == '总股本']
@@ -431,26 +507,26 @@ def get_stock_shares_from_akshare(stock_code):
                         elif '亿' in shares_str:
                             total_shares *= 100000000
                         print(f"解析得到总股本: {total_shares} 股")
-                        return {'success': True, 'total_shares': total_shares}
+                        return {'success': True, 'total_shares': total_shares, 'source': 'akshare_em'}
                 else:
                     print("基本信息中未找到总股本字段")
                     # 使用估算股本（基于市值和价格）
                     print("使用估算股本...")
                     estimated_shares = 10000000000  # 估算100亿股
-                    return {'success': True, 'total_shares': estimated_shares}
+                    return {'success': True, 'total_shares': estimated_shares, 'source': 'estimate'}
         except Exception as e:
             print(f"从基本信息获取股本失败: {e}")
 
         # 如果都失败了，使用默认估算值
         print("使用默认估算股本...")
         estimated_shares = 10000000000  # 估算100亿股
-        return {'success': True, 'total_shares': estimated_shares}
+        return {'success': True, 'total_shares': estimated_shares, 'source': 'estimate'}
 
     except Exception as e:
         print(f"获取股本信息总体错误: {e}")
         # 即使出错也返回估算值，确保DCF计算能继续
         estimated_shares = 10000000000  # 估算100亿股
-        return {'success': True, 'total_shares': estimated_shares}
+        return {'success': True, 'total_shares': estimated_shares, 'source': 'estimate'}
 
 
 def get_simplified_financial_data(stock_code):
@@ -461,7 +537,7 @@ def get_simplified_financial_data(stock_code):
         # 尝试使用基础API获取关键指标
         try:
             # 获取股票基本信息，包含一些财务指标
-            stock_info = ak.stock_individual_info_em(symbol=stock_code)
+            stock_info = upstream.call('stock_individual_info_em', symbol=stock_code)
             if stock_info is not None and not stock_info.empty:
                 print(f"股票基本信息获取成功: {len(stock_info)} 条记录")
                 print(f"可用信息: {stock_info['item'].tolist()}")
@@ -504,6 +580,7 @@ def get_simplified_financial_data(stock_code):
 
 @stock_bp.route('/search', methods=['POST'])
 @token_required
+@rate_limit('search', RATE_LIMIT_SEARCH)
 def search_stock():
     """搜索股票信息"""
     data = request.get_json()
@@ -525,150 +602,869 @@ def search_stock():
         return jsonify({'error': result['message']}), 404
 
 
+@stock_bp.route('/suggest', methods=['GET'])
+@token_required
+@rate_limit('suggest', RATE_LIMIT_SUGGEST)
+def suggest_stock():
+    """股票代码/名称自动补全"""
+    query = request.args.get('q', '').strip()
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        return jsonify({'error': 'limit参数无效'}), 400
+
+    if not query:
+        return jsonify({'success': True, 'suggestions': []})
+
+    try:
+        suggestions = stock_directory.suggest(query, limit)
+    except Exception as e:
+        return jsonify({'error': f'获取股票目录失败: {str(e)}'}), 500
+
+    return jsonify({'success': True, 'suggestions': suggestions})
+
+
+# DCF模型参数：(类型, 默认值)
+DCF_PARAMETERS = {
+    'discount_rate': (float, 0.1),
+    'stage1_years': (int, 5),
+    'stage1_growth': (float, 0.1),
+    'stage2_years': (int, 5),
+    'stage2_growth': (float, 0.05),
+    'stage3_years': (int, 0),
+    'stage3_growth': (float, 0.02),
+}
+
+# 敏感性分析每个维度最多的取值个数
+SENSITIVITY_MAX_STEPS = int(os.getenv('SENSITIVITY_MAX_STEPS', 50))
+
+# 估值结果缓存的容量与有效期（秒）
+VALUATION_CACHE_SIZE = int(os.getenv('VALUATION_CACHE_SIZE', 1024))
+VALUATION_CACHE_TTL = float(os.getenv('VALUATION_CACHE_TTL', 300))
+
+# 估值结果缓存：键为 (股票代码, 规范化的参数元组)，
+# 版本为 (该股票 financial_data 的最新 updated_at, 行情快照时间)，任一变化即失效
+valuation_cache = LRUCache(maxsize=VALUATION_CACHE_SIZE, ttl=VALUATION_CACHE_TTL)
+
+# 异步估值任务：在有界线程池中计算，任务状态默认保存在进程内存
+valuation_jobs = jobs.JobRunner()
+
+# 批量估值一次最多的股票数
+BATCH_VALUATION_MAX_CODES = int(os.getenv('BATCH_VALUATION_MAX_CODES', 100))
+
+# 蒙特卡洛模拟可抽样的参数，fcf 为历史平均FCF的乘数
+MONTE_CARLO_PARAMETERS = ('fcf', 'discount_rate', 'stage1_growth', 'stage2_growth', 'stage3_growth')
+# 蒙特卡洛模拟的最大抽样次数
+MONTE_CARLO_MAX_DRAWS = int(os.getenv('MONTE_CARLO_MAX_DRAWS', 1000000))
+
+
+def parse_dcf_parameters(data):
+    """从请求数据中解析DCF参数，未提供的使用默认值"""
+    return {name: cast(data.get(name, default)) for name, (cast, default) in DCF_PARAMETERS.items()}
+
+
+def valuation_cache_key(stock_code, params):
+    """估值缓存键：股票代码 + 按固定顺序排列并规范化的参数"""
+    return stock_code, tuple(round(params[name], 10) for name in DCF_PARAMETERS)
+
+
+def valuation_cache_version(stock_code):
+    """
+    估值缓存的版本号：(financial_data 中该股票的最新 updated_at, 行情快照时间)
+    查询失败时返回None，表示本次不使用缓存
+    """
+    try:
+        row = db.query_db(
+            'SELECT MAX(updated_at) AS updated_at FROM financial_data WHERE stock_code = %s',
+            (stock_code,),
+            one=True
+        )
+    except Exception as e:
+        print(f"获取估值缓存版本失败: {e}")
+        return None
+    return (row['updated_at'] if row else None), quote_snapshot.updated_at
+
+
+def calculate_fcf_history(financial_data):
+    """根据历年财务数据计算自由现金流"""
+    dcf_model = DCFValuation()
+    fcf_list = []
+
+    for year_data in financial_data:
+        # 计算营运资本变动（简化处理，使用流动资产-流动负债的变化）
+        working_capital = year_data['current_assets'] - year_data['current_liabilities']
+        # 为简化，假设营运资本变动为当年营运资本的10%
+        change_wc = working_capital * 0.1
+
+        fcf = dcf_model.fcf_by_net_income(
+            year_data['net_income'],
+            year_data['interest_expense'],
+            0,  # 摊销（包含在折旧中）
+            year_data['depreciation'],
+            change_wc,
+            abs(year_data['capex'])  # 资本支出取绝对值
+        )
+        fcf_list.append(fcf)
+
+    return fcf_list
+
+
+def price_from_quote(stock_code, quote):
+    """从行情快照的一行中取最新价，取不到时使用估算价格"""
+    import pandas as pd
+
+    if quote is not None and pd.notna(quote['最新价']):
+        current_price = float(quote['最新价'])
+        print(f"获取到股票 {stock_code} 的当前市场价格: ¥{current_price}")
+        return current_price
+
+    print(f"未找到股票代码 {stock_code} 的市场数据，使用估算价格")
+    return 10.0  # 估算价格
+
+
+def resolve_total_shares(stock_code, quote=None):
+    """
+    在本地解析总股本：股本存储 -> 行情快照推算 -> AKShare（本地都没有时才访问网络）
+    返回 {'success', 'total_shares', 'source', 'effective_date'}；
+    source 为 'estimate' 表示使用了估算值，估算值不会写入股本存储
+    """
+    share_store.start(current_app._get_current_object())
+
+    record = share_store.get(stock_code)
+    if record is None:
+        total_shares = shares_from_quote(quote)
+        if total_shares > 0:
+            record = share_store.put(stock_code, total_shares, 'market_snapshot')
+
+    if record is None:
+        shares_result = get_stock_shares_from_akshare(stock_code)
+        if not shares_result['success']:
+            return shares_result
+        if shares_result['source'] == 'estimate':
+            return {
+                'success': True,
+                'total_shares': shares_result['total_shares'],
+                'source': 'estimate',
+                'effective_date': None
+            }
+        record = share_store.put(stock_code, shares_result['total_shares'], shares_result['source'])
+
+    return {
+        'success': True,
+        'total_shares': record['total_shares'],
+        'source': record['source'],
+        'effective_date': record['effective_date']
+    }
+
+
+def make_valuation_inputs(financial_result, shares_result, current_price, snapshot_age):
+    """根据财务数据、股本和价格组装估值输入"""
+    financial_data = financial_result['data']
+
+    # 计算平均自由现金流
+    fcf_list = calculate_fcf_history(financial_data)
+    avg_fcf = sum(fcf_list) / len(fcf_list) if fcf_list else 0
+
+    return {
+        'success': True,
+        'financial_years': len(financial_data),
+        'fcf_list': fcf_list,
+        'avg_fcf': avg_fcf,
+        'total_shares': shares_result['total_shares'],
+        'shares_source': shares_result['source'],
+        'shares_effective_date': shares_result['effective_date'],
+        'current_price': current_price,
+        'snapshot_age': snapshot_age,
+        # 检查是否有备注信息（使用了估算数据）
+        'note': financial_result.get('note', '')
+    }
+
+
+def load_valuation_inputs(stock_code):
+    """
+    获取估值所需的全部输入：财务数据、历年FCF、股本、当前价格
+    只依赖股票代码，与DCF参数无关，可被多组参数的计算复用
+    """
+    # 先尝试从数据库获取财务数据，如果没有则生成fake数据
+    financial_result = get_financial_data_mixed(stock_code)
+    if not financial_result['success']:
+        return financial_result
+
+    if len(financial_result['data']) == 0:
+        return {'success': False, 'message': '没有找到财务数据'}
+
+    print(f"正在获取股票 {stock_code} 的当前市场价格...")
+    quote, snapshot_age = quote_snapshot.get(stock_code)
+
+    # 获取股本信息（本地股本存储）
+    shares_result = resolve_total_shares(stock_code, quote)
+    if not shares_result['success']:
+        return shares_result
+
+    return make_valuation_inputs(financial_result, shares_result, price_from_quote(stock_code, quote), snapshot_age)
+
+
+def _batch_inputs(stock_code, db_result, quote, snapshot_age):
+    """批量估值中单只股票的估值输入，db_result 为批量查询的结果"""
+    financial_result = get_financial_data_mixed(stock_code, db_result)
+    if not financial_result['success']:
+        return financial_result
+    if len(financial_result['data']) == 0:
+        return {'success': False, 'message': '没有找到财务数据'}
+
+    shares_result = resolve_total_shares(stock_code, quote)
+    if not shares_result['success']:
+        return shares_result
+
+    return make_valuation_inputs(financial_result, shares_result, price_from_quote(stock_code, quote), snapshot_age)
+
+
+def _batch_inputs_in_context(app, *args):
+    # 在线程池中执行，需要自己的应用上下文（数据库连接）
+    with app.app_context():
+        return _batch_inputs(*args)
+
+
+def load_valuation_inputs_batch(stock_codes):
+    """
+    批量获取多只股票的估值输入：
+    财务数据用一次 IN (...) 查询获取，价格从同一份行情快照中解析，股本从本地股本存储解析；
+    需要访问网络的股票（库中没有或已过期、本地没有股本）在有界线程池中并发获取，
+    整批最多等待 BATCH_FALLBACK_TIMEOUT 秒，未完成的按获取失败返回（后台获取完成后会写回数据库）
+    返回 {股票代码: 与 load_valuation_inputs 相同格式的结果}
+    """
+    db_results = get_financial_data_from_database_batch(stock_codes)
+    quotes, snapshot_age = quote_snapshot.get_many(stock_codes)
+    app = current_app._get_current_object()
+    share_store.start(app)
+
+    all_inputs = {}
+    futures = {}
+    for stock_code in stock_codes:
+        db_result = db_results.get(stock_code, {'success': False, 'message': '数据库中未找到该股票的财务数据'})
+        quote = quotes.get(stock_code)
+        local = (db_result['success'] and not db_result['stale']
+                 and (share_store.get(stock_code) is not None or shares_from_quote(quote) > 0))
+        if local:
+            all_inputs[stock_code] = _batch_inputs(stock_code, db_result, quote, snapshot_age)
+        else:
+            futures[batch_fallback_executor.submit(
+                _batch_inputs_in_context, app, stock_code, db_result, quote, snapshot_age
+            )] = stock_code
+
+    if futures:
+        done, not_done = wait(futures, timeout=BATCH_FALLBACK_TIMEOUT)
+        for future in done:
+            try:
+                all_inputs[futures[future]] = future.result()
+            except Exception as e:
+                all_inputs[futures[future]] = {'success': False, 'message': f'获取财务数据失败: {str(e)}'}
+        for future in not_done:
+            future.cancel()
+            all_inputs[futures[future]] = {
+                'success': False, 'message': f'获取财务数据超时（{BATCH_FALLBACK_TIMEOUT:g}秒），请稍后重试'
+            }
+
+    return all_inputs
+
+
+def shares_age_days(effective_date):
+    """股本生效日期距今的天数，估算值返回None"""
+    if effective_date is None:
+        return None
+    return (datetime.date.today() - effective_date).days
+
+
+def build_valuation_result(stock_code, inputs, params):
+    """用已获取的估值输入和一组DCF参数计算估值结果"""
+    avg_fcf = inputs['avg_fcf']
+    total_shares = inputs['total_shares']
+    current_price = inputs['current_price']
+    snapshot_age = inputs['snapshot_age']
+
+    # 计算企业价值
+    enterprise_value = DCFValuation().common_dcf(avg_fcf, **params)
+
+    # 计算每股价值
+    price_per_share = enterprise_value / total_shares if total_shares > 0 else 0
+
+    valuation_result = {
+        'stock_code': stock_code,
+        'avg_fcf': round(avg_fcf / 100000000, 2),  # 转换为亿元
+        'enterprise_value': round(enterprise_value / 100000000, 2),  # 转换为亿元
+        'total_shares': round(total_shares / 100000000, 2),  # 转换为亿股
+        'shares_source': inputs['shares_source'],  # 股本来源
+        'shares_age_days': shares_age_days(inputs['shares_effective_date']),  # 股本数据距今天数
+        'price_per_share': round(price_per_share, 2),
+        'current_market_price': round(current_price, 2),
+        'price_snapshot_age': round(snapshot_age, 1) if snapshot_age is not None else None,
+        'valuation_ratio': round((price_per_share / current_price) if current_price > 0 else 0, 2),
+        'financial_years': inputs['financial_years'],
+        'fcf_history': [round(fcf / 100000000, 2) for fcf in inputs['fcf_list']],  # 历年FCF（亿元）
+        'parameters': dict(params)
+    }
+
+    # 如果使用了估算数据，添加警告信息
+    if inputs['note']:
+        valuation_result['warning'] = inputs['note']
+    if inputs['shares_source'] == 'estimate':
+        valuation_result['shares_warning'] = '无法获取总股本，使用了估算值，结果仅供参考'
+
+    return valuation_result
+
+
+def parse_sensitivity_axis(axis):
+    """
+    解析敏感性分析的一个维度，支持两种写法：
+    {'param': 'discount_rate', 'values': [0.08, 0.09, 0.1]}
+    {'param': 'discount_rate', 'start': 0.08, 'stop': 0.12, 'steps': 20}
+    """
+    name = axis.get('param')
+    if name not in DCF_PARAMETERS:
+        raise ValueError(f'不支持的参数: {name}')
+    cast = DCF_PARAMETERS[name][0]
+
+    if 'values' in axis:
+        values = [float(value) for value in axis['values']]
+    else:
+        start = float(axis['start'])
+        stop = float(axis['stop'])
+        steps = int(axis.get('steps', 10))
+        if steps < 2:
+            raise ValueError('steps至少为2')
+        values = [start + (stop - start) * i / (steps - 1) for i in range(steps)]
+
+    if not values or len(values) > SENSITIVITY_MAX_STEPS:
+        raise ValueError(f'参数 {name} 的取值个数需在1到{SENSITIVITY_MAX_STEPS}之间')
+    # 年数类参数取整
+    return name, [cast(round(value)) if cast is int else value for value in values]
+
+
+def compute_valuation(stock_code, params):
+    """
+    计算单只股票的估值（优先使用缓存）
+    返回 {'success': True, 'valuation_result', 'cached'} 或 {'success': False, 'message'}
+    """
+    cache_key = valuation_cache_key(stock_code, params)
+    version = valuation_cache_version(stock_code)
+    if version is not None:
+        cached = valuation_cache.get(cache_key, version=version)
+        if cached is not None:
+            return {'success': True, 'valuation_result': cached, 'cached': True}
+
+    inputs = load_valuation_inputs(stock_code)
+    if not inputs['success']:
+        return inputs
+
+    valuation_result = build_valuation_result(stock_code, inputs, params)
+
+    # 计算过程中可能写回了财务数据或刷新了快照，按计算后的版本写入缓存
+    version = valuation_cache_version(stock_code)
+    if version is not None:
+        valuation_cache.set(cache_key, valuation_result, version=version)
+
+    return {'success': True, 'valuation_result': valuation_result, 'cached': False}
+
+
+def parse_valuation_request(data):
+    """解析单只股票估值请求，返回 (股票代码, DCF参数)"""
+    stock_code = str(data.get('stock_code', '')).strip()
+    if not stock_code:
+        raise ValueError('请提供股票代码')
+    return stock_code, parse_dcf_parameters(data)
+
+
+def run_valuation_job(stock_code, params):
+    """异步估值任务：数据不足等业务错误也作为任务失败"""
+    result = compute_valuation(stock_code, params)
+    if not result['success']:
+        raise ValueError(result['message'])
+    return result
+
+
 @stock_bp.route('/valuation', methods=['POST'])
 @token_required
+@rate_limit('valuation', RATE_LIMIT_VALUATION)
 def calculate_valuation():
     """计算股票DCF估值"""
     data = request.get_json()
 
     # 获取参数
     stock_code = data.get('stock_code', '').strip()
-    discount_rate = float(data.get('discount_rate', 0.1))
-    stage1_years = int(data.get('stage1_years', 5))
-    stage1_growth = float(data.get('stage1_growth', 0.1))
-    stage2_years = int(data.get('stage2_years', 5))
-    stage2_growth = float(data.get('stage2_growth', 0.05))
-    stage3_years = int(data.get('stage3_years', 0))
-    stage3_growth = float(data.get('stage3_growth', 0.02))
+    params = parse_dcf_parameters(data)
 
     if not stock_code:
         return jsonify({'error': '请提供股票代码'}), 400
 
     try:
-        # 先尝试从数据库获取财务数据，如果没有则生成fake数据
-        financial_result = get_financial_data_mixed(stock_code)
-        if not financial_result['success']:
-            return jsonify({'error': financial_result['message']}), 400
-
-        financial_data = financial_result['data']
-        if len(financial_data) == 0:
-            return jsonify({'error': '没有找到财务数据'}), 400
-
-        # 计算平均自由现金流
-        dcf_model = DCFValuation()
-        fcf_list = []
-
-        for year_data in financial_data:
-            # 计算营运资本变动（简化处理，使用流动资产-流动负债的变化）
-            working_capital = year_data['current_assets'] - year_data['current_liabilities']
-            # 为简化，假设营运资本变动为当年营运资本的10%
-            change_wc = working_capital * 0.1
-
-            fcf = dcf_model.fcf_by_net_income(
-                year_data['net_income'],
-                year_data['interest_expense'],
-                0,  # 摊销（包含在折旧中）
-                year_data['depreciation'],
-                change_wc,
-                abs(year_data['capex'])  # 资本支出取绝对值
-            )
-            fcf_list.append(fcf)
+        result = compute_valuation(stock_code, params)
+        if not result['success']:
+            return jsonify({'error': result['message']}), 400
+        return jsonify(result)
+
+    except Exception as e:
+        return jsonify({'error': f'计算估值时出错: {str(e)}'}), 500
+
+
+def format_sse(event, data):
+    """把一个事件编码为 text/event-stream 格式"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+def stream_valuation_events(stock_code, params):
+    """
+    逐阶段计算估值，每完成一个阶段产出一个 (事件名, 数据)：
+    financial_data -> fcf -> enterprise_value -> market_price -> shares -> result
+    每个事件带 elapsed_ms（本阶段耗时）、timings（到目前为止各阶段耗时）
+    和 stale_upstreams（到目前为止返回了旧数据的上游；流式响应的响应头在计算开始前已发出，
+    无法再设置 Warning 头），出错时产出 error 事件并结束；命中缓存时直接产出 result
+    """
+    timings = {}
+
+    def timed(stage, started):
+        timings[stage] = round((time.perf_counter() - started) * 1000, 1)
+        return {'elapsed_ms': timings[stage], 'timings': dict(timings),
+                'stale_upstreams': upstream.stale_upstreams()}
+
+    started = time.perf_counter()
+    cache_key = valuation_cache_key(stock_code, params)
+    version = valuation_cache_version(stock_code)
+    if version is not None:
+        cached = valuation_cache.get(cache_key, version=version)
+        if cached is not None:
+            yield 'result', {'valuation_result': cached, 'cached': True, **timed('cache', started)}
+            return
+
+    # 财务数据
+    started = time.perf_counter()
+    financial_result = get_financial_data_mixed(stock_code)
+    if not financial_result['success'] or len(financial_result['data']) == 0:
+        yield 'error', {'error': financial_result.get('message') or '没有找到财务数据'}
+        return
+    yield 'financial_data', {
+        'financial_years': len(financial_result['data']),
+        'warning': financial_result.get('note', ''),
+        **timed('financial_data', started)
+    }
+
+    # 历年FCF
+    started = time.perf_counter()
+    fcf_list = calculate_fcf_history(financial_result['data'])
+    avg_fcf = sum(fcf_list) / len(fcf_list) if fcf_list else 0
+    yield 'fcf', {
+        'fcf_history': [round(fcf / 100000000, 2) for fcf in fcf_list],  # 历年FCF（亿元）
+        'avg_fcf': round(avg_fcf / 100000000, 2),  # 亿元
+        **timed('fcf', started)
+    }
+
+    # 企业价值只依赖FCF和参数，不必等待价格和股本
+    started = time.perf_counter()
+    enterprise_value = DCFValuation().common_dcf(avg_fcf, **params)
+    yield 'enterprise_value', {
+        'enterprise_value': round(enterprise_value / 100000000, 2),  # 亿元
+        **timed('enterprise_value', started)
+    }
+
+    # 当前价格（行情快照）
+    started = time.perf_counter()
+    quote, snapshot_age = quote_snapshot.get(stock_code)
+    current_price = price_from_quote(stock_code, quote)
+    yield 'market_price', {
+        'current_market_price': round(current_price, 2),
+        'price_snapshot_age': round(snapshot_age, 1) if snapshot_age is not None else None,
+        **timed('market_price', started)
+    }
+
+    # 总股本
+    started = time.perf_counter()
+    shares_result = resolve_total_shares(stock_code, quote)
+    if not shares_result['success']:
+        yield 'error', {'error': shares_result['message']}
+        return
+    yield 'shares', {
+        'total_shares': round(shares_result['total_shares'] / 100000000, 2),  # 亿股
+        'shares_source': shares_result['source'],
+        **timed('shares', started)
+    }
+
+    # 完整结果与 /valuation 相同
+    started = time.perf_counter()
+    inputs = make_valuation_inputs(financial_result, shares_result, current_price, snapshot_age)
+    valuation_result = build_valuation_result(stock_code, inputs, params)
+    version = valuation_cache_version(stock_code)
+    if version is not None:
+        valuation_cache.set(cache_key, valuation_result, version=version)
+    yield 'result', {'valuation_result': valuation_result, 'cached': False, **timed('result', started)}
+
+
+@stock_bp.route('/valuation/stream', methods=['POST'])
+@token_required
+@rate_limit('valuation', RATE_LIMIT_VALUATION)
+def stream_valuation():
+    """
+    以 Server-Sent Events 流式返回估值进度，参数与 /valuation 相同
+    每个阶段完成后立即推送部分结果，最后推送 result 事件（或 error 事件）
+    """
+    data = request.get_json() or {}
+    try:
+        stock_code, params = parse_valuation_request(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'参数无效: {str(e)}'}), 400
+
+    def generate():
+        try:
+            for event, payload in stream_valuation_events(stock_code, params):
+                yield format_sse(event, payload)
+        except Exception as e:
+            yield format_sse('error', {'error': f'计算估值时出错: {str(e)}'})
 
-        # 计算平均FCF
-        avg_fcf = sum(fcf_list) / len(fcf_list) if fcf_list else 0
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # 关闭反向代理（如nginx）的缓冲，保证事件即时到达
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
-        # 计算企业价值
-        enterprise_value = dcf_model.common_dcf(
-            avg_fcf, discount_rate, stage1_years, stage1_growth,
-            stage2_years, stage2_growth, stage3_years, stage3_growth
+
+@stock_bp.route('/valuation/jobs', methods=['POST'])
+@token_required
+@rate_limit('valuation', RATE_LIMIT_VALUATION)
+def submit_valuation_job():
+    """
+    提交异步估值任务，参数与 /valuation 相同
+    立即返回任务ID（202），通过 GET /valuation/jobs/<job_id> 查询状态和结果
+    """
+    data = request.get_json() or {}
+    try:
+        stock_code, params = parse_valuation_request(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'参数无效: {str(e)}'}), 400
+
+    try:
+        job = valuation_jobs.submit(
+            current_app._get_current_object(), 'valuation', run_valuation_job, stock_code, params,
+            owner_id=g.user['id']
         )
+    except jobs.JobQueueFullError as e:
+        return jsonify({'error': f'估值任务过多，请稍后重试: {str(e)}'}), 503
 
-        # 获取股本信息（从AKShare获取）
-        shares_result = get_stock_shares_from_akshare(stock_code)
-        if not shares_result['success']:
-            return jsonify({'error': shares_result['message']}), 400
+    response = jsonify({'success': True, 'job_id': job['id'], 'status': job['status']})
+    response.status_code = 202
+    response.headers['Location'] = f"{stock_bp.url_prefix}/valuation/jobs/{job['id']}"
+    return response
 
-        total_shares = shares_result['total_shares']
 
-        # 计算每股价值
-        price_per_share = enterprise_value / total_shares if total_shares > 0 else 0
+@stock_bp.route('/valuation/jobs/<job_id>', methods=['GET'])
+@token_required
+def get_valuation_job(job_id):
+    """
+    查询异步估值任务；成功时 result 与 /valuation 的响应格式相同，失败时 error 为错误信息
+    只能查询自己提交的任务，其他用户的任务同样返回404
+    """
+    job = valuation_jobs.get(job_id)
+    if job is None or job['owner_id'] != g.user['id']:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+    return jsonify({'success': True, 'job': job})
+
+
+@stock_bp.route('/valuation/jobs', methods=['GET'])
+@token_required
+def valuation_job_stats():
+    """异步估值任务队列的统计"""
+    return jsonify({'success': True, 'jobs': valuation_jobs.stats()})
 
-        # 获取当前市场价格进行比较
-        try:
-            print(f"正在获取股票 {stock_code} 的当前市场价格...")
-            current_price_data = ak.stock_zh_a_spot_em()
-            if current_price_data is not None and not current_price_data.empty:
-                current_stock = current_price_data[current_price_data['代码'] == stock_code]
-                if not current_stock.empty:
-                    current_price = float(current_stock.iloc[0]['最新价'])
-                    print(f"获取到当前市场价格: ¥{current_price}")
-                else:
-                    print(f"未找到股票代码 {stock_code} 的市场数据，使用估算价格")
-                    current_price = 10.0  # 估算价格
+
+@stock_bp.route('/valuation/cache', methods=['GET'])
+@token_required
+def valuation_cache_stats():
+    """估值结果缓存的命中统计"""
+    return jsonify({'success': True, 'cache': valuation_cache.stats()})
+
+
+@stock_bp.route('/valuation/batch', methods=['POST'])
+@token_required
+@rate_limit('valuation_heavy', RATE_LIMIT_VALUATION_HEAVY)
+def calculate_valuation_batch():
+    """
+    批量DCF估值
+    stock_codes 中的元素可以是股票代码，也可以是 {'stock_code': ..., 参数...}，
+    顶层的DCF参数作为所有股票的默认值，元素中的参数覆盖默认值
+    """
+    data = request.get_json()
+    items = data.get('stock_codes')
+
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': '请提供股票代码列表'}), 400
+    if len(items) > BATCH_VALUATION_MAX_CODES:
+        return jsonify({'error': f'一次最多估值 {BATCH_VALUATION_MAX_CODES} 只股票'}), 400
+
+    try:
+        default_params = parse_dcf_parameters(data)
+        valuation_requests = []
+        for item in items:
+            if isinstance(item, dict):
+                stock_code = str(item.get('stock_code', '')).strip()
+                params = parse_dcf_parameters({**default_params, **item})
             else:
-                print("市场数据API返回空，使用估算价格")
-                current_price = 10.0  # 估算价格
-        except Exception as e:
-            print(f"获取市场价格失败: {e}，使用估算价格")
-            current_price = 10.0  # 估算价格
+                stock_code = str(item).strip()
+                params = default_params
+            if not stock_code:
+                raise ValueError('股票代码不能为空')
+            valuation_requests.append((stock_code, params))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'参数无效: {str(e)}'}), 400
 
-        # 检查是否有备注信息（使用了估算数据）
-        note = financial_result.get('note', '')
+    try:
+        # 同一股票只获取一次数据
+        stock_codes = list(dict.fromkeys(stock_code for stock_code, _ in valuation_requests))
+        all_inputs = load_valuation_inputs_batch(stock_codes)
+
+        results = []
+        for stock_code, params in valuation_requests:
+            inputs = all_inputs[stock_code]
+            if inputs['success']:
+                results.append({
+                    'success': True,
+                    'valuation_result': build_valuation_result(stock_code, inputs, params)
+                })
+            else:
+                results.append({'success': False, 'stock_code': stock_code, 'error': inputs['message']})
+
+        return jsonify({'success': True, 'results': results})
+
+    except Exception as e:
+        return jsonify({'error': f'批量计算估值时出错: {str(e)}'}), 500
+
+
+@stock_bp.route('/valuation/sensitivity', methods=['POST'])
+@token_required
+@rate_limit('valuation_heavy', RATE_LIMIT_VALUATION_HEAVY)
+def valuation_sensitivity():
+    """
+    估值敏感性分析：财务数据、股本、价格只获取一次，
+    在两个参数的取值网格上一次性批量计算每股价值
+    """
+    import numpy as np
+    from . import dcf
+
+    data = request.get_json()
+
+    stock_code = data.get('stock_code', '').strip()
+    params = parse_dcf_parameters(data)
+
+    if not stock_code:
+        return jsonify({'error': '请提供股票代码'}), 400
+
+    try:
+        x_name, x_values = parse_sensitivity_axis(data.get('x') or {})
+        y_name, y_values = parse_sensitivity_axis(data.get('y') or {})
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'敏感性参数无效: {str(e)}'}), 400
+
+    if x_name == y_name:
+        return jsonify({'error': 'x和y必须是不同的参数'}), 400
+
+    try:
+        inputs = load_valuation_inputs(stock_code)
+        if not inputs['success']:
+            return jsonify({'error': inputs['message']}), 400
+
+        # x取值沿第0维、y取值沿第1维，广播得到 len(x) * len(y) 的网格
+        grid_params = dict(params)
+        grid_params[x_name] = np.asarray(x_values)[:, np.newaxis]
+        grid_params[y_name] = np.asarray(y_values)[np.newaxis, :]
+        enterprise_values = dcf.enterprise_values(inputs['avg_fcf'], **grid_params)
+
+        total_shares = inputs['total_shares']
+        if total_shares > 0:
+            price_grid = enterprise_values / total_shares
+        else:
+            price_grid = np.zeros_like(enterprise_values)
 
         result = {
             'success': True,
-            'valuation_result': {
+            'sensitivity': {
                 'stock_code': stock_code,
-                'avg_fcf': round(avg_fcf / 100000000, 2),  # 转换为亿元
-                'enterprise_value': round(enterprise_value / 100000000, 2),  # 转换为亿元
-                'total_shares': round(total_shares / 100000000, 2),  # 转换为亿股
-                'price_per_share': round(price_per_share, 2),
-                'current_market_price': round(current_price, 2),
-                'valuation_ratio': round((price_per_share / current_price) if current_price > 0 else 0, 2),
-                'financial_years': len(financial_data),
-                'fcf_history': [round(fcf / 100000000, 2) for fcf in fcf_list],  # 历年FCF（亿元）
-                'parameters': {
-                    'discount_rate': discount_rate,
-                    'stage1_years': stage1_years,
-                    'stage1_growth': stage1_growth,
-                    'stage2_years': stage2_years,
-                    'stage2_growth': stage2_growth,
-                    'stage3_years': stage3_years,
-                    'stage3_growth': stage3_growth
-                }
+                'x': {'param': x_name, 'values': x_values},
+                'y': {'param': y_name, 'values': y_values},
+                # price_per_share[i][j] 对应 x_values[i]、y_values[j]
+                'price_per_share': dcf.to_rounded_list(price_grid),
+                'current_market_price': round(inputs['current_price'], 2),
+                'price_snapshot_age': round(inputs['snapshot_age'], 1) if inputs['snapshot_age'] is not None else None,
+                'avg_fcf': round(inputs['avg_fcf'] / 100000000, 2),  # 亿元
+                'total_shares': round(total_shares / 100000000, 2),  # 亿股
+                'parameters': params
             }
         }
+        if inputs['note']:
+            result['sensitivity']['warning'] = inputs['note']
+
+        return jsonify(result)
+
+    except Exception as e:
+        return jsonify({'error': f'计算敏感性分析时出错: {str(e)}'}), 500
+
+
+@stock_bp.route('/valuation/montecarlo', methods=['POST'])
+@token_required
+@rate_limit('valuation_heavy', RATE_LIMIT_VALUATION_HEAVY)
+def valuation_montecarlo():
+    """
+    蒙特卡洛估值：按用户给定的分布对折现率、各阶段增长率和FCF基数抽样，
+    向量化计算全部抽样的每股价值，返回分位数、直方图和高于当前价格的概率
+    """
+    import numpy as np
+    from . import dcf
+
+    data = request.get_json()
+
+    stock_code = data.get('stock_code', '').strip()
+    params = parse_dcf_parameters(data)
+    distributions = data.get('distributions') or {}
+
+    if not stock_code:
+        return jsonify({'error': '请提供股票代码'}), 400
+
+    try:
+        draws = int(data.get('draws', 100000))
+        bins = int(data.get('bins', 50))
+        seed = int(data.get('seed', 0))
+        unknown = set(distributions) - set(MONTE_CARLO_PARAMETERS)
+        if unknown:
+            raise ValueError(f'不支持抽样的参数: {", ".join(sorted(unknown))}')
+        if not 1 <= draws <= MONTE_CARLO_MAX_DRAWS:
+            raise ValueError(f'抽样次数需在1到{MONTE_CARLO_MAX_DRAWS}之间')
+        if not 1 <= bins <= 200:
+            raise ValueError('直方图桶数需在1到200之间')
+
+        # 固定种子的生成器，相同请求得到相同结果
+        rng = np.random.default_rng(seed)
+        samples = {name: dcf.sample(rng, distributions[name], draws)
+                   for name in MONTE_CARLO_PARAMETERS if name in distributions}
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        return jsonify({'error': f'模拟参数无效: {str(e)}'}), 400
+
+    try:
+        inputs = load_valuation_inputs(stock_code)
+        if not inputs['success']:
+            return jsonify({'error': inputs['message']}), 400
+
+        total_shares = inputs['total_shares']
+        if total_shares <= 0:
+            return jsonify({'error': '无法获取有效的股本数据'}), 400
+
+        started = time.perf_counter()
+        sampled_params = dict(params)
+        sampled_params.update({name: values for name, values in samples.items() if name != 'fcf'})
+        fcf = inputs['avg_fcf'] * samples.get('fcf', 1.0)
+        price_per_share = np.broadcast_to(
+            dcf.enterprise_values(fcf, **sampled_params) / total_shares, (draws,)
+        )
 
-        # 如果使用了估算数据，添加警告信息
-        if note:
-            result['valuation_result']['warning'] = note
+        # 永续增长模型要求折现率大于永续增长率，其余抽样视为无效
+        valid = np.isfinite(price_per_share)
+        if params['stage3_years'] == 0:
+            valid &= np.asarray(sampled_params['discount_rate']) > np.asarray(sampled_params['stage3_growth'])
+        valid_values = price_per_share[valid]
+        if valid_values.size == 0:
+            return jsonify({'error': '所有抽样都无效，请检查折现率与永续增长率的分布'}), 400
+
+        current_price = inputs['current_price']
+        summary = dcf.summarize_distribution(valid_values, current_price, bins)
+        prob_above = summary.pop('prob_above_reference')
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        result = {
+            'success': True,
+            'montecarlo': {
+                'stock_code': stock_code,
+                'draws': draws,
+                'valid_draws': int(valid_values.size),
+                'seed': seed,
+                'price_per_share': summary,
+                'prob_above_market_price': prob_above,
+                'current_market_price': round(current_price, 2),
+                'price_snapshot_age': round(inputs['snapshot_age'], 1) if inputs['snapshot_age'] is not None else None,
+                'avg_fcf': round(inputs['avg_fcf'] / 100000000, 2),  # 亿元
+                'total_shares': round(total_shares / 100000000, 2),  # 亿股
+                'parameters': params,
+                'distributions': distributions,
+                'elapsed_ms': round(elapsed_ms, 1)
+            }
+        }
+        if inputs['note']:
+            result['montecarlo']['warning'] = inputs['note']
 
         return jsonify(result)
 
     except Exception as e:
-        return jsonify({'error': f'计算估值时出错: {str(e)}'}), 500
+        return jsonify({'error': f'蒙特卡洛估值时出错: {str(e)}'}), 500
+
+
+@stock_bp.route('/financial-data/export', methods=['GET'])
+@token_required
+@rate_limit('export', RATE_LIMIT_EXPORT)
+def export_financial_data():
+    """
+    导出 financial_data 表（可用 ?stock_code= 过滤），默认为NDJSON，?format=json 时为JSON数组
+    使用服务端游标流式输出，内存占用与表大小无关
+    """
+    query = '''SELECT stock_code, company_name, report_year, report_date,
+                      net_income, interest_expense, depreciation, capex,
+                      current_assets, current_liabilities, total_shares, updated_at
+               FROM financial_data'''
+    args = ()
+    stock_code = request.args.get('stock_code', '').strip()
+    if stock_code:
+        query += ' WHERE stock_code = %s'
+        args = (stock_code,)
+    query += ' ORDER BY stock_code, report_year'
+
+    return db.streaming_response(query, args, ndjson=request.args.get('format') != 'json')
+
+
+@stock_bp.route('/upstream/stats', methods=['GET'])
+@token_required
+def upstream_stats():
+    """上游（AKShare）调用统计"""
+    return jsonify({'success': True, 'upstream': upstream.stats()})
+
+
+@stock_bp.route('/shares/stats', methods=['GET'])
+@token_required
+def share_store_stats():
+    """总股本存储统计（含数据库加载和写入失败情况）"""
+    return jsonify({'success': True, 'shares': share_store.stats()})
+
+
+@stock_bp.route('/ratelimit/stats', methods=['GET'])
+@token_required
+def ratelimit_stats():
+    """限流统计"""
+    return jsonify({'success': True, 'ratelimit': limiter.stats()})
 
 
 @stock_bp.route('/market-data/<stock_code>', methods=['GET'])
 @token_required
+@rate_limit('market_data', RATE_LIMIT_MARKET_DATA)
 def get_market_data(stock_code):
     """获取股票市场数据"""
     try:
-        # 获取实时价格
-        current_price_data = ak.stock_zh_a_spot_em()
-        current_stock = current_price_data[current_price_data['代码'] == stock_code]
+        # 获取实时价格（从共享行情快照中按代码查询）
+        stock_data, snapshot_age = quote_snapshot.get(stock_code)
 
-        if current_stock.empty:
+        if stock_data is None:
             return jsonify({'error': '未找到股票市场数据'}), 404
 
-        stock_data = current_stock.iloc[0]
-
-        # 获取基本信息
-        stock_info = ak.stock_individual_info_em(symbol=stock_code)
+        # 获取基本信息（上游不可用时PE/PB置0，不影响行情数据）
         pe_ratio = 0
         pb_ratio = 0
+        try:
+            stock_info = upstream.call('stock_individual_info_em', symbol=stock_code)
+        except Exception as e:
+            print(f"获取股票 {stock_code} 基本信息失败: {e}")
+            stock_info = None
 
-        if not stock_info.empty:
+        if stock_info is not None and not stock_info.empty:
             pe_row = stock_info[stock_info['item'] == '市盈率-动态']
             pb_row = stock_info[stock_info['item'] == '市净率']
 
@@ -697,7 +1493,9 @@ def get_market_data(stock_code):
                 'yesterday_close': float(stock_data['昨收']),
                 'pe_ratio': pe_ratio,
                 'pb_ratio': pb_ratio
-            }
+            },
+            'snapshot_age': round(snapshot_age, 1),
+            'stale': bool(upstream.stale_upstreams())
         })
 
     except Exception as e:
@@ -0,0 +1,296 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from flask import g, has_request_context
+
+from .cache import LRUCache
+
+'''
+AKShare 调用的统一入口
+所有对 akshare 的调用都通过 call() 发出：
+- 请求合并：并发的相同调用（同一函数、同样参数）只会真正请求一次，其余调用者共享结果
+- 熔断：每个上游函数一个熔断器，连续失败或慢调用达到阈值后打开，
+  打开期间直接返回最近一次成功的结果（标记为陈旧数据），并在后台探测恢复
+  只有网络/超时/服务端错误才计为失败；参数错误、代码不存在、数据为空等由上游正常返回的错误
+  只影响本次调用，不计入熔断（否则几个不存在的股票代码就能让所有股票的请求熔断）
+- 陈旧数据兜底：上游变慢或出错时，有旧数据就先返回旧数据，请求在后台继续完成并刷新缓存
+'''
+
+# 同时进行的上游请求数上限
+UPSTREAM_MAX_WORKERS = int(os.getenv('UPSTREAM_MAX_WORKERS', 32))
+# 连续失败（含慢调用）多少次后熔断
+UPSTREAM_FAILURE_THRESHOLD = int(os.getenv('UPSTREAM_FAILURE_THRESHOLD', 3))
+# 超过该耗时（秒）的调用视为慢调用；有旧数据时调用方最多等待这么久
+UPSTREAM_SLOW_CALL_SECONDS = float(os.getenv('UPSTREAM_SLOW_CALL_SECONDS', 5))
+# 熔断打开后多久（秒）进行一次恢复探测
+UPSTREAM_RESET_TIMEOUT = float(os.getenv('UPSTREAM_RESET_TIMEOUT', 30))
+# 最近一次成功结果的缓存条数
+UPSTREAM_LAST_GOOD_SIZE = int(os.getenv('UPSTREAM_LAST_GOOD_SIZE', 512))
+# 超过该行数的结果（如全市场行情表）不放入旧数据缓存，避免缓存占用过多内存
+UPSTREAM_LAST_GOOD_MAX_ROWS = int(os.getenv('UPSTREAM_LAST_GOOD_MAX_ROWS', 1000))
+
+_MISSING = object()
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开，且没有可用的旧数据"""
+
+
+def is_upstream_failure(error):
+    """
+    异常是否表示上游不可用（计入熔断）：连接失败、超时、5xx/429 响应
+    akshare 对不存在的代码、空数据等通常抛出 KeyError/ValueError/TypeError 等，视为正常结果
+    """
+    # requests 由 akshare 间接依赖，出错时才导入
+    import requests
+
+    if isinstance(error, requests.HTTPError):
+        response = error.response
+        return response is None or response.status_code >= 500 or response.status_code == 429
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError))
+
+
+class SingleFlight:
+    """请求合并：相同 key 的并发调用共享同一个 Future"""
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0  # 真正执行的调用次数
+        self.coalesced = 0  # 被合并（节省）的调用次数
+
+    def submit(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = self._calls[key] = self._executor.submit(fn, *args, **kwargs)
+            self.executed += 1
+
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._calls),
+            }
+
+
+class CircuitBreaker:
+    """
+    单个上游函数的熔断器
+    连续失败或慢调用达到阈值后打开；打开 reset_timeout 秒后允许一次后台探测，
+    探测成功则关闭，失败则重新计时
+    """
+
+    def __init__(self, name, failure_threshold=UPSTREAM_FAILURE_THRESHOLD,
+                 slow_call_seconds=UPSTREAM_SLOW_CALL_SECONDS, reset_timeout=UPSTREAM_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.trips = 0
+        self._abandoned = set()  # 调用方已等待超时、已按失败记录过的请求
+        self._lock = threading.Lock()
+
+    def allow(self):
+        return self.state == 'closed'
+
+    def should_probe(self):
+        """熔断打开且到了探测时间时返回True（同一时间只允许一个探测）"""
+        with self._lock:
+            if (self.state == 'open' and not self.probing
+                    and time.monotonic() - self.opened_at >= self.reset_timeout):
+                self.probing = True
+                return True
+            return False
+
+    def record_timeout(self, key, waited):
+        """
+        调用方等待 key 对应的请求超时：不等请求结束（可能一直挂起），立即计一次失败
+        每次超时都计数，一直挂起的请求也能让熔断打开；请求之后完成时不再重复记录
+        """
+        with self._lock:
+            self._abandoned.add(key)
+        self.record(False, waited)
+
+    def record(self, ok, elapsed, key=None):
+        with self._lock:
+            self.probing = False
+            if key is not None and key in self._abandoned:
+                self._abandoned.discard(key)
+                return
+            if ok and elapsed <= self.slow_call_seconds:
+                if self.state == 'open':
+                    print(f"上游 {self.name} 已恢复，熔断关闭")
+                self.state = 'closed'
+                self.consecutive_failures = 0
+                return
+
+            self.consecutive_failures += 1
+            if self.state == 'open':
+                # 探测失败，重新计时
+                self.opened_at = time.monotonic()
+            elif self.consecutive_failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.trips += 1
+                print(f"上游 {self.name} 连续 {self.consecutive_failures} 次失败或过慢，熔断打开")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'trips': self.trips,
+            }
+
+
+_executor = ThreadPoolExecutor(max_workers=UPSTREAM_MAX_WORKERS, thread_name_prefix='upstream')
+single_flight = SingleFlight(_executor)
+last_good = LRUCache(maxsize=UPSTREAM_LAST_GOOD_SIZE)
+_breakers = {}
+_breakers_lock = threading.Lock()
+# 上游函数名 -> 替代实现（测试时用本地的假上游代替 akshare）
+_overrides = {}
+
+
+def get_breaker(name):
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(name, CircuitBreaker(name))
+    return breaker
+
+
+@contextmanager
+def override(name, fn):
+    """在 with 块内用 fn 代替 akshare 中名为 name 的函数"""
+    _overrides[name] = fn
+    try:
+        yield
+    finally:
+        _overrides.pop(name, None)
+
+
+def _resolve(name):
+    fn = _overrides.get(name)
+    if fn is not None:
+        return fn
+    # akshare 导入需要数秒（会连带导入pandas等），只在第一次真正调用上游时导入
+    import akshare as ak
+    return getattr(ak, name)
+
+
+def _keep_last_good(result):
+    """结果是否放入旧数据缓存：跳过空结果和大表"""
+    if result is None:
+        return False
+    try:
+        return 0 < len(result) <= UPSTREAM_LAST_GOOD_MAX_ROWS
+    except TypeError:
+        return True
+
+
+def _fetch(name, key, kwargs, keep):
+    """真正请求上游：记录耗时和成败，keep 为True时成功结果写入旧数据缓存"""
+    breaker = get_breaker(name)
+    started = time.monotonic()
+    try:
+        result = _resolve(name)(**kwargs)
+    except Exception as e:
+        breaker.record(not is_upstream_failure(e), time.monotonic() - started, key)
+        raise
+    breaker.record(True, time.monotonic() - started, key)
+    if keep and _keep_last_good(result):
+        last_good.set(key, result)
+    return result
+
+
+def mark_stale(name):
+    """记录当前请求使用了上游 name 的旧数据（响应会带 Warning 头）"""
+    if has_request_context():
+        g.setdefault('stale_upstreams', set()).add(name)
+
+
+def _serve_stale(name, stale):
+    if stale is _MISSING:
+        raise CircuitOpenError(f'上游 {name} 暂不可用')
+    mark_stale(name)
+    print(f"上游 {name} 不可用或过慢，返回旧数据")
+    return stale
+
+
+def call(name, stale_ok=True, wait_seconds=None, **kwargs):
+    """
+    调用 akshare 中名为 name 的函数，kwargs 为函数参数
+    stale_ok 为True时，上游熔断、过慢或出错时返回最近一次成功的结果（记入 stale_upstreams()）；
+    为False时只接受新数据（熔断时抛出 CircuitOpenError）
+    wait_seconds 为没有旧数据时最多等待的秒数（默认一直等待），超时计为一次失败并抛出 CircuitOpenError
+    返回的 DataFrame 可能被多个调用者共享，调用者不应原地修改
+    """
+    key = (name, tuple(sorted(kwargs.items())))
+    breaker = get_breaker(name)
+    stale = last_good.get(key, _MISSING) if stale_ok else _MISSING
+
+    if not breaker.allow():
+        # 熔断打开：不等待上游，必要时在后台探测
+        if breaker.should_probe():
+            single_flight.submit(key, _fetch, name, key, kwargs, stale_ok)
+        return _serve_stale(name, stale)
+
+    future = single_flight.submit(key, _fetch, name, key, kwargs, stale_ok)
+    try:
+        # 有旧数据时最多等待一个慢调用阈值，没有旧数据时等待 wait_seconds
+        timeout = breaker.slow_call_seconds if stale is not _MISSING else wait_seconds
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        # 挂起的请求要等结束才会被记录，这里先计为失败，让持续挂起的上游也能熔断；
+        # 请求继续在后台完成并刷新旧数据缓存
+        breaker.record_timeout(key, timeout)
+        return _serve_stale(name, stale)
+    except Exception:
+        if stale is _MISSING:
+            raise
+        return _serve_stale(name, stale)
+
+
+def call_direct(name, **kwargs):
+    """
+    绕过请求合并、熔断和旧数据缓存，直接调用 akshare 中名为 name 的函数
+    用于批量抓取等离线任务：大量无数据/已退市的代码不会打开线上请求共用的熔断器，结果也不占用旧数据缓存
+    """
+    return _resolve(name)(**kwargs)
+
+
+def stale_upstreams():
+    """当前请求中返回过旧数据的上游函数"""
+    if not has_request_context():
+        return []
+    return sorted(g.get('stale_upstreams', ()))
+
+
+def stats():
+    """上游调用统计"""
+    return {
+        'single_flight': single_flight.stats(),
+        'breakers': {name: breaker.stats() for name, breaker in list(_breakers.items())},
+        'last_good': last_good.stats(),
+    }
@@ -0,0 +1,45 @@
+import { ref } from 'vue'
+import { ElMessage } from 'element-plus'
+
+// 游标分页列表：接口返回 { posts, next }，next 为下一页的游标（没有下一页时为null）
+// fetchFirst 重新加载第一页，loadMore 按游标把下一页追加到列表末尾
+export function useCursorPagination(url, errorMessage = '获取帖子列表失败') {
+  const items = ref([])
+  const nextCursor = ref(null)
+  const loadingMore = ref(false)
+
+  const fetchPage = async (cursor) => {
+    const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : ''
+    const response = await fetch(`${url}${query}`)
+    return response.json()
+  }
+
+  const fetchFirst = async () => {
+    try {
+      const data = await fetchPage(null)
+      items.value = data.posts
+      nextCursor.value = data.next
+    } catch (error) {
+      console.error('Error fetching posts:', error)
+      ElMessage.error(errorMessage)
+    }
+  }
+
+  // 按游标加载下一页
+  const loadMore = async () => {
+    if (!nextCursor.value || loadingMore.value) return
+    loadingMore.value = true
+    try {
+      const data = await fetchPage(nextCursor.value)
+      items.value = items.value.concat(data.posts)
+      nextCursor.value = data.next
+    } catch (error) {
+      console.error('Error fetching posts:', error)
+      ElMessage.error(errorMessage)
+    } finally {
+      loadingMore.value = false
+    }
+  }
+
+  return { items, nextCursor, loadingMore, fetchFirst, loadMore }
+}
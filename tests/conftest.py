@@ -0,0 +1,17 @@
+import pytest
+from flask import Flask
+
+from backend import upstream
+from backend.cache import LRUCache
+
+
+@pytest.fixture
+def app():
+    return Flask(__name__)
+
+
+@pytest.fixture(autouse=True)
+def isolated_upstream(monkeypatch):
+    """每个测试使用自己的熔断器和旧数据缓存，不修改进程内共享的实例"""
+    monkeypatch.setattr(upstream, '_breakers', {})
+    monkeypatch.setattr(upstream, 'last_good', LRUCache(maxsize=upstream.UPSTREAM_LAST_GOOD_SIZE))
@@ -0,0 +1,52 @@
+import time
+
+from backend import upstream
+
+
+class FakeUpstream:
+    """可切换成功/失败/变慢的假上游函数，记录被调用的次数"""
+
+    def __init__(self, value):
+        self.value = value
+        self.error = None
+        self.delay = 0
+        self.calls = 0
+
+    def __call__(self, **kwargs):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class FakeFrame:
+    """只实现 QuoteSnapshot.refresh 用到的 DataFrame 接口"""
+
+    def __init__(self, records):
+        self._records = records
+
+    def __len__(self):
+        return len(self._records)
+
+    @property
+    def empty(self):
+        return not self._records
+
+    def to_dict(self, orient):
+        return list(self._records)
+
+
+def use_breaker(name, **kwargs):
+    """为上游 name 注册一个测试自己的熔断器（测试之间由 isolated_upstream 夹具隔离）"""
+    breaker = upstream.CircuitBreaker(name, **kwargs)
+    upstream._breakers[name] = breaker
+    return breaker
+
+
+def wait_idle(timeout=2):
+    """等待后台的上游请求（如熔断探测、超时后仍在进行的请求）全部完成"""
+    deadline = time.monotonic() + timeout
+    while upstream.single_flight.stats()['in_flight'] and time.monotonic() < deadline:
+        time.sleep(0.01)
@@ -0,0 +1,16 @@
+import pytest
+
+from backend.auth import token_from_header
+
+
+@pytest.mark.parametrize('header, token', [
+    ('Bearer abc.def', 'abc.def'),
+    ('bearer  abc.def ', 'abc.def'),
+    ('abc.def', 'abc.def'),
+    ('Bearer', None),
+    ('Basic dXNlcjpwYXNz', None),
+    ('', None),
+    (None, None),
+])
+def test_token_from_header(header, token):
+    assert token_from_header(header) == token
@@ -0,0 +1,46 @@
+import time
+
+from backend import upstream
+from backend.market import QuoteSnapshot, SNAPSHOT_UPSTREAM
+from .fakes import FakeFrame, FakeUpstream, use_breaker
+
+
+def make_snapshot(monkeypatch, **kwargs):
+    snapshot = QuoteSnapshot(interval=3600, **kwargs)
+    # 不启动后台刷新线程，只测试请求中的刷新
+    monkeypatch.setattr(snapshot, 'start', lambda: None)
+    return snapshot
+
+
+def test_stale_snapshot_served_while_breaker_open(app, monkeypatch):
+    fake = FakeUpstream(FakeFrame([{'代码': '000001', '最新价': 10.5}]))
+    breaker = use_breaker(SNAPSHOT_UPSTREAM, failure_threshold=1)
+    snapshot = make_snapshot(monkeypatch, max_age=0.1)
+
+    with upstream.override(SNAPSHOT_UPSTREAM, fake):
+        snapshot.refresh()
+        fake.error = ConnectionError('upstream down')
+        time.sleep(snapshot.max_age * 2)
+        with app.test_request_context():
+            quote, age = snapshot.get('000001')
+            assert quote['最新价'] == 10.5
+            assert age > snapshot.max_age
+            assert upstream.stale_upstreams() == [SNAPSHOT_UPSTREAM]
+    assert breaker.state == 'open'
+
+
+def test_requests_do_not_queue_behind_a_refresh(app, monkeypatch):
+    fake = FakeUpstream(FakeFrame([{'代码': '000001', '最新价': 10.5}]))
+    use_breaker(SNAPSHOT_UPSTREAM)
+    snapshot = make_snapshot(monkeypatch, max_age=0.1, refresh_timeout=5)
+
+    with upstream.override(SNAPSHOT_UPSTREAM, fake):
+        snapshot.refresh()
+    time.sleep(snapshot.max_age * 2)
+
+    # 模拟另一个线程的刷新正卡在上游
+    with snapshot._refresh_lock, app.test_request_context():
+        started = time.monotonic()
+        quote, _ = snapshot.get('000001')
+        assert quote['最新价'] == 10.5
+        assert time.monotonic() - started < 1
@@ -0,0 +1,43 @@
+import pytest
+from flask import g
+
+from backend import ratelimit
+
+USER = ('user:1:test', 1 / 60, 2)
+IP = ('ip:127.0.0.1:test', 1 / 60, 1)
+
+
+def check_rejection_does_not_debit(backend):
+    allowed, levels = backend.take([USER, IP])
+    assert allowed
+    assert [round(tokens) for tokens in levels] == [1, 0]
+
+    # IP桶为空：拒绝，且不扣减用户桶
+    allowed, levels = backend.take([USER, IP])
+    assert not allowed
+    assert round(levels[0]) == 1
+
+    allowed, levels = backend.take([USER])
+    assert allowed
+    assert round(levels[0]) == 0
+
+
+def test_memory_backend_checks_all_buckets_before_debiting():
+    check_rejection_does_not_debit(ratelimit.MemoryBackend())
+
+
+def test_redis_script_checks_all_buckets_before_debiting():
+    # 需要支持Lua脚本的本地Redis替身：pip install "fakeredis[lua]"
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    check_rejection_does_not_debit(ratelimit.RedisBackend(fakeredis.FakeRedis()))
+
+
+def test_limiter_reports_the_rejecting_bucket(app):
+    limiter = ratelimit.RateLimiter(backend=ratelimit.MemoryBackend(), ip_factor=1)
+    with app.test_request_context(environ_base={'REMOTE_ADDR': '127.0.0.1'}):
+        g.user = {'id': 1}
+        assert limiter.check('test', 1, 60)['allowed']
+        state = limiter.check('test', 1, 60)
+        assert not state['allowed']
+        assert state['retry_after'] > 0
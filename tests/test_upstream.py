@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+from backend import upstream
+from .fakes import FakeUpstream, use_breaker, wait_idle
+
+NAME = 'fake_upstream'
+
+
+def test_breaker_opens_serves_stale_and_recovers(app):
+    fake = FakeUpstream('v1')
+    breaker = use_breaker(NAME, failure_threshold=2, slow_call_seconds=0.2, reset_timeout=0.2)
+
+    with upstream.override(NAME, fake), app.test_request_context():
+        assert upstream.call(NAME) == 'v1'
+        assert breaker.state == 'closed'
+
+        fake.error = ConnectionError('upstream down')
+        for _ in range(breaker.failure_threshold):
+            assert upstream.call(NAME) == 'v1'
+        assert upstream.stale_upstreams() == [NAME]
+        assert breaker.state == 'open'
+
+        calls = fake.calls
+        assert upstream.call(NAME) == 'v1'
+        assert fake.calls == calls
+        with pytest.raises(upstream.CircuitOpenError):
+            upstream.call(NAME, stale_ok=False)
+
+        fake.error = None
+        fake.value = 'v2'
+        time.sleep(breaker.reset_timeout)
+        # 探测在后台进行，期间继续返回旧数据
+        assert upstream.call(NAME) == 'v1'
+        wait_idle()
+        assert breaker.state == 'closed'
+        assert upstream.call(NAME) == 'v2'
+
+
+def test_slow_call_serves_stale_and_counts_as_failure(app):
+    fake = FakeUpstream('v1')
+    breaker = use_breaker(NAME, failure_threshold=3, slow_call_seconds=0.2)
+
+    with upstream.override(NAME, fake), app.test_request_context():
+        assert upstream.call(NAME) == 'v1'
+        fake.value = 'v2'
+        fake.delay = breaker.slow_call_seconds * 3
+        started = time.monotonic()
+        assert upstream.call(NAME) == 'v1'
+        assert time.monotonic() - started < fake.delay
+        wait_idle()
+        # 调用方超时时计一次失败，请求之后完成时不再重复记录
+        assert breaker.consecutive_failures == 1
+        assert upstream.last_good.get((NAME, ())) == 'v2'
+
+
+def test_argument_errors_do_not_trip_breaker():
+    fake = FakeUpstream(None)
+    fake.error = KeyError('data')
+    breaker = use_breaker(NAME, failure_threshold=2)
+
+    with upstream.override(NAME, fake):
+        for _ in range(5):
+            with pytest.raises(KeyError):
+                upstream.call(NAME, symbol='999999')
+    assert breaker.state == 'closed'
+    assert breaker.consecutive_failures == 0
+
+
+def test_hung_call_times_out_and_trips_breaker():
+    fake = FakeUpstream('v1')
+    fake.delay = 1
+    breaker = use_breaker(NAME, failure_threshold=2)
+
+    with upstream.override(NAME, fake):
+        for _ in range(breaker.failure_threshold):
+            started = time.monotonic()
+            with pytest.raises(upstream.CircuitOpenError):
+                upstream.call(NAME, stale_ok=False, wait_seconds=0.1)
+            assert time.monotonic() - started < fake.delay
+        assert breaker.state == 'open'
+        wait_idle()
+
+
+def test_last_good_skips_bulk_results(monkeypatch):
+    monkeypatch.setattr(upstream, 'UPSTREAM_LAST_GOOD_MAX_ROWS', 3)
+    use_breaker(NAME)
+
+    with upstream.override(NAME, FakeUpstream([1, 2, 3, 4])):
+        upstream.call(NAME, symbol='big')
+    with upstream.override(NAME, FakeUpstream([1])):
+        upstream.call(NAME, symbol='small')
+        upstream.call(NAME, stale_ok=False, symbol='fresh_only')
+
+    assert upstream.last_good.get((NAME, (('symbol', 'big'),))) is None
+    assert upstream.last_good.get((NAME, (('symbol', 'small'),))) == [1]
+    assert upstream.last_good.get((NAME, (('symbol', 'fresh_only'),))) is None